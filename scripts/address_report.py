@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Parser of the output of the debugger's !address command.
+"""
+
+# imports
+from __future__ import print_function
+import logging
+import os
+import re
+import sys
+
+from docopt import docopt
+
+
+# constants
+
+__version__ = 1.0
+_REPORT_EXT_ = '.txt'
+_METADATA_EXT_ = ['.heaps', '.stacks', '.pdata']
+# same filters as the show_heaps, show_stacks and show_private_data scripts
+_HEAP_LINE_ = re.compile(r'^[0-9a-fA-F]{8}   Heap \(Private')
+_EXCLUDED_ = ('Reserved', 'No access', 'Guard')
+
+
+# exception classes
+
+
+# interface classes
+
+class RegionType:
+    Heap = '.heaps'
+    Stack = '.stacks'
+    Pdata = '.pdata'
+
+
+# interface functions
+
+def classify_line(line):
+    '''
+    Returns the RegionType of a line of a !address report, or None
+    if the line does not describe a heap, a committed thread stack
+    or committed private data.
+    '''
+    if _HEAP_LINE_.match(line):
+        return RegionType.Heap
+    if not line.startswith('  ') or any(x in line for x in _EXCLUDED_):
+        return None
+    if 'Thread Stack' in line:
+        return RegionType.Stack
+    if 'Private Data' in line and 'Heap' not in line:
+        return RegionType.Pdata
+    return None
+
+
+def extract_metadata(reportfile):
+    '''
+    Reads the !address report "reportfile" once and writes its heap,
+    stack and private data lines to the .heaps, .stacks and .pdata
+    files of the memory dump. Returns the number of lines written
+    per file extension.
+    '''
+    dumpfile = _dump_name(reportfile)
+    counts = dict.fromkeys(_METADATA_EXT_, 0)
+    outputs = dict((ext, open(dumpfile + ext, 'w')) for ext in _METADATA_EXT_)
+    try:
+        with open(reportfile, 'r') as f:
+            for line in f:
+                ext = classify_line(line)
+                if ext:
+                    outputs[ext].write(line)
+                    counts[ext] += 1
+    finally:
+        for f in outputs.itervalues():
+            f.close()
+    logging.debug('{}: {} heaps, {} stacks, {} private data'.format(
+        reportfile, counts['.heaps'], counts['.stacks'], counts['.pdata']))
+    return counts
+
+
+def find_reports(paths):
+    '''
+    Returns the !address reports in "paths", searching directories
+    recursively.
+    '''
+    reports = list()
+    for path in paths:
+        if not os.path.isdir(path):
+            reports.append(path)
+            continue
+        for (dirpath, _, filenames) in os.walk(path):
+            reports.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                           if f.endswith(_REPORT_EXT_))
+    return reports
+
+
+# internal functions
+
+def _dump_name(reportfile):
+    if reportfile.endswith(_REPORT_EXT_):
+        return reportfile[:-len(_REPORT_EXT_)]
+    return reportfile
+
+
+def _process_cmd_line(argv):
+    '''!address report parser.
+
+Extracts the .heaps, .stacks and .pdata files of memory dumps from the
+output of the debugger's !address command.
+
+Usage:
+    address_report.py [-v] <report>...
+    address_report.py (-h | --help | --version)
+
+Options:
+    <report>      The !address reports, or directories with them.
+    -v --verbose  Verbose.
+    -h --help     Shows this help.
+    --version     Shows the current version.
+    '''
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    return args['<report>'], args['--verbose']
+
+
+def main(argv=None):
+    paths, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    for reportfile in find_reports(paths):
+        extract_metadata(reportfile)
+        logging.info('{} extracted'.format(reportfile))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Benchmark of the graph pipeline over synthetic memory dumps.
+"""
+
+# imports
+from __future__ import print_function
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import graph_diffing
+import graph_generator
+import memorydump
+import synthetic_dump
+
+
+# constants
+
+__version__ = 1.0
+_MB_ = 1024.0 * 1024.0
+_DUMP_FILES_ = ['.core', '.segments', '.modules', '.heaps', '.stacks',
+                '.pdata']
+
+# exception classes
+
+
+# interface classes
+
+
+# interface functions
+
+def run_benchmark(workdir, dumps=3, mmapped=False, **options):
+    """Generates a series of synthetic memory dumps in workdir
+    and times each stage of the graph pipeline over them. The
+    options are passed to synthetic_dump.generate_dump.
+
+    Returns a list of (stage, seconds, amount, unit, memory) tuples,
+    where memory is the peak resident set size in MB of the process
+    so far, not of the stage alone.
+    """
+    dumpfiles = _dump_names(workdir, dumps)
+    for (i, dumpfile) in enumerate(dumpfiles):
+        synthetic_dump.generate_dump(dumpfile, snapshot=i, **options)
+    logging.debug('{} synthetic dumps generated'.format(dumps))
+    core_size = sum(os.path.getsize(d + '.core') for d in dumpfiles) / _MB_
+
+    results = list()
+    loaded, t = _timed(memorydump.load_memory_dump, dumpfiles, mmapped)
+    results.append(('load_memory_dump', t, core_size, 'MB', _peak_memory()))
+    compact, t = _timed(graph_generator.generate_compact_graph, loaded)
+    results.append(('generate_compact_graph', t, core_size, 'MB',
+                    _peak_memory()))
+    del compact
+    graphs, t = _timed(graph_generator.generate_graph, loaded)
+    results.append(('generate_graph', t, core_size, 'MB', _peak_memory()))
+    nodes = sum(len(g) for g in graphs)
+    start = time.time()
+    diff = graph_diffing.diff_memory_graphs(graphs)
+    results.append(('diff_memory_graphs', time.time() - start, nodes,
+                    'nodes', _peak_memory()))
+    # diff_graph.dot is written to a private directory
+    cwd = os.getcwd()
+    dotdir = tempfile.mkdtemp(prefix='sigpath-benchmark-')
+    os.chdir(dotdir)
+    try:
+        start = time.time()
+        graph_diffing.extract_diff_graph(graphs[-1], diff)
+        results.append(('extract_diff_graph', time.time() - start,
+                        len(graphs[-1]), 'nodes', _peak_memory()))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(dotdir, ignore_errors=True)
+    return results
+
+
+def benchmark_files(workdir, dumps=3):
+    """Returns the paths of the files of the synthetic memory dumps
+    that run_benchmark writes to workdir.
+    """
+    return [d + ext for d in _dump_names(workdir, dumps)
+            for ext in _DUMP_FILES_]
+
+
+# internal classes
+
+
+# internal functions
+
+def _timed(function, dumps, *args):
+    start = time.time()
+    results = [function(d, *args) for d in dumps]
+    return results, time.time() - start
+
+
+def _dump_names(workdir, dumps):
+    return [os.path.join(workdir, 'bench{}'.format(i)) for i in xrange(dumps)]
+
+
+def _remove_dumps(workdir, dumps):
+    """Removes the files of the synthetic memory dumps from a
+    directory the benchmark did not create.
+    """
+    for filename in benchmark_files(workdir, dumps):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _peak_memory():
+    """Returns the peak resident set size of the process so far in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _process_cmd_line(argv):
+    """Graph pipeline benchmark over synthetic memory dumps.
+
+Usage:
+    benchmark.py [options]
+    benchmark.py (--help | --version)
+
+Options:
+    -d --dumps <n>        Number of synthetic dumps [default: 3].
+    --heaps <n>           Number of heaps per dump [default: 2].
+    --heap-size <kb>      Size of each heap in KB [default: 1024].
+    --alloc-size <bytes>  Mean allocation size [default: 64].
+    --density <p>         Fraction of words that are pointers [default: 0.1].
+    --mutation <p>        Fraction of allocations changed between dumps
+                          [default: 0.01].
+    -w --workdir <dir>    Directory for the synthetic dumps.
+    -k --keep             Keeps the synthetic dumps.
+    -m --mmap             Memory-maps the .core files instead of reading them.
+    -h --help             Shows this message.
+    -v --verbose          Shows details.
+    --version             Shows the current version.
+    """
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    # checking arguments
+    try:
+        options = dict(dumps=int(args['--dumps']),
+                       heaps=int(args['--heaps']),
+                       heap_size=int(args['--heap-size']),
+                       alloc_size=int(args['--alloc-size']),
+                       density=float(args['--density']),
+                       mutation=float(args['--mutation']))
+    except ValueError as e:
+        print('Error:', e, file=sys.stderr)
+        sys.exit(1)
+
+    if args['--verbose']:
+        print(args)
+    return (options, args['--workdir'], args['--keep'], args['--mmap'],
+            args['--verbose'])
+
+
+def main(argv=None):
+    options, workdir, keep, mmapped, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    created = not workdir
+    if created:
+        workdir = tempfile.mkdtemp(prefix='sigpath-benchmark-')
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        results = run_benchmark(workdir, mmapped=mmapped, **options)
+    finally:
+        if not keep and created:
+            shutil.rmtree(workdir, ignore_errors=True)
+        elif not keep:
+            _remove_dumps(workdir, options['dumps'])
+
+    print('{:<24}{:>10}{:>22}{:>22}'.format('Stage', 'Time (s)',
+                                             'Throughput',
+                                             'Max RSS so far (MB)'))
+    for (stage, seconds, amount, unit, peak) in results:
+        throughput = '{:.1f} {}/s'.format(amount / seconds if seconds
+                                          else float('inf'), unit)
+        print('{:<24}{:>10.2f}{:>22}{:>22.1f}'.format(stage, seconds,
+                                                      throughput, peak))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
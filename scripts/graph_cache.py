@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Persistent, content-addressed cache of memory graphs.
+"""
+
+# imports
+from __future__ import print_function
+import hashlib
+import logging
+import os
+import struct
+import sys
+
+from docopt import docopt
+import numpy as np
+
+from graph_generator import CompactMemoryGraph
+import graph_generator
+import memorydump
+
+
+# constants
+
+__version__ = 1.0
+_MAGIC_ = 'SGPC'
+_FORMAT_VERSION_ = 1
+_HEADER_ = struct.Struct('<4sIII')
+_NODE_DTYPE_ = np.dtype([('kind', 'u1'), ('address', '<u8'),
+                         ('size', '<u8'), ('offset', '<u8')])
+_EDGE_DTYPE_ = np.dtype([('src', '<u4'), ('dest', '<u4'),
+                         ('offset_src', '<u4'), ('offset_dest', '<u4')])
+_DUMP_FILES_ = ['.core', '.segments', '.heaps', '.modules', '.stacks']
+_READ_SZ_ = 1 << 20
+_KEY_EXT_ = '.key.cache'
+# memoized cache keys by the (path, size, mtime) of the dump's files
+_KEYS_ = dict()
+
+# exception classes
+
+
+# interface classes
+
+
+# interface functions
+
+def cached_graph(dump, compact=False):
+    """Returns the memory graph of a memory dump. The graph is
+    read from the cache when the dump's files and the generator
+    have not changed; otherwise it is generated and stored.
+    If compact is True a CompactMemoryGraph is returned.
+    """
+    filename = cache_filename(dump.name)
+    if os.path.exists(filename):
+        try:
+            graph = load_graph(filename, dump, compact)
+            logging.debug('{} loaded'.format(filename))
+            return graph
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring {}: {}'.format(filename, e))
+    if compact:
+        graph = graph_generator.generate_compact_graph(dump)
+    else:
+        graph = graph_generator.generate_graph(dump)
+    store_graph(filename, graph)
+    logging.debug('{} created'.format(filename))
+    return graph
+
+
+def cache_filename(dumpfile):
+    """Returns the content-addressed cache file name of a memory
+    dump, next to its files.
+    """
+    return os.path.join(os.path.dirname(dumpfile),
+                        '{}.cache'.format(cache_key(dumpfile)))
+
+
+def cache_key(dumpfile):
+    """Returns the hash of the memory dump's files, or of its
+    minidump, and of the graph generator and cache format versions.
+    The hash is memoized, in memory and in a .key.cache file next to
+    the dump, by the path, size and modification time of the files,
+    which are only read again when one of them changes.
+    """
+    if dumpfile.endswith('.dmp'):
+        files = [dumpfile]
+    else:
+        files = [dumpfile + ext for ext in _DUMP_FILES_]
+    stamp = (graph_generator.__version__, _FORMAT_VERSION_,
+             tuple(_file_stamp(f) for f in files))
+    if stamp in _KEYS_:
+        return _KEYS_[stamp]
+    keyfile = dumpfile + _KEY_EXT_
+    key = _load_key(keyfile, stamp)
+    if key is None:
+        digest = hashlib.sha1('{}:{}'.format(graph_generator.__version__,
+                                             _FORMAT_VERSION_))
+        for f in files:
+            digest.update(_file_digest(f))
+        key = digest.hexdigest()
+        _store_key(keyfile, stamp, key)
+    _KEYS_[stamp] = key
+    return key
+
+
+def store_graph(filename, graph):
+    """Writes the nodes, edges and pointer labels of a memory
+    graph to a cache file.
+    """
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(pack_graph(graph))
+    os.rename(temp, filename)
+
+
+def load_graph(filename, dump, compact=False):
+    """Reads a memory graph from a cache file. The nodes are
+    rebuilt over the data of the memory dump.
+    """
+    with open(filename, 'rb') as f:
+        return unpack_graph(f.read(), dump, compact)
+
+
+def pack_graph(graph):
+    """Returns the compact binary representation of a memory graph.
+    """
+    if not isinstance(graph, CompactMemoryGraph):
+        graph = CompactMemoryGraph.from_memory_graph(graph)
+    node_table = np.zeros(len(graph), dtype=_NODE_DTYPE_)
+    node_table['kind'] = graph.kind
+    node_table['address'] = graph.address
+    node_table['size'] = graph.size
+    node_table['offset'] = graph.offset
+    edge_table = np.zeros(graph.number_of_edges(), dtype=_EDGE_DTYPE_)
+    edge_table['src'] = graph.src
+    edge_table['dest'] = graph.dest
+    edge_table['offset_src'] = graph.offset_src
+    edge_table['offset_dest'] = graph.offset_dest
+    return (_HEADER_.pack(_MAGIC_, _FORMAT_VERSION_, len(node_table),
+                          len(edge_table)) +
+            node_table.tobytes() + edge_table.tobytes())
+
+
+def unpack_graph(packed, dump, compact=False):
+    """Rebuilds a memory graph from its compact binary
+    representation and the memory dump it was generated from.
+    """
+    if len(packed) < _HEADER_.size:
+        raise ValueError('Truncated graph')
+    magic, version, nnodes, nedges = _HEADER_.unpack_from(packed)
+    if magic != _MAGIC_ or version != _FORMAT_VERSION_:
+        raise ValueError('Unknown graph format')
+    if len(packed) != (_HEADER_.size + nnodes * _NODE_DTYPE_.itemsize +
+                       nedges * _EDGE_DTYPE_.itemsize):
+        raise ValueError('Truncated graph')
+    node_table = np.frombuffer(packed, dtype=_NODE_DTYPE_, count=nnodes,
+                               offset=_HEADER_.size)
+    edge_table = np.frombuffer(packed, dtype=_EDGE_DTYPE_, count=nedges,
+                               offset=_HEADER_.size + node_table.nbytes)
+    if nedges and max(edge_table['src'].max(),
+                      edge_table['dest'].max()) >= nnodes:
+        raise ValueError('Corrupted graph')
+    graph = CompactMemoryGraph(dump, node_table['address'],
+                               node_table['size'], node_table['offset'],
+                               node_table['kind'], edge_table['src'],
+                               edge_table['dest'], edge_table['offset_src'],
+                               edge_table['offset_dest'])
+    return graph if compact else graph.to_memory_graph()
+
+
+# internal classes
+
+
+# internal functions
+
+def _file_stamp(filename):
+    info = os.stat(filename)
+    return os.path.abspath(filename), info.st_size, info.st_mtime
+
+
+def _load_key(keyfile, stamp):
+    """Returns the key stored in keyfile if it was computed for the
+    same stamp, or None.
+    """
+    try:
+        with open(keyfile, 'r') as f:
+            stored_stamp, key = f.read().rsplit('\n', 1)
+    except (IOError, ValueError):
+        return None
+    return key if stored_stamp == repr(stamp) else None
+
+
+def _store_key(keyfile, stamp, key):
+    temp = '{}.{}.tmp'.format(keyfile, os.getpid())
+    try:
+        with open(temp, 'w') as f:
+            f.write('{!r}\n{}'.format(stamp, key))
+        os.rename(temp, keyfile)
+    except (IOError, OSError) as e:
+        logging.warning('Ignoring {}: {}'.format(keyfile, e))
+
+
+def _file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_SZ_), ''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _process_cmd_line(argv):
+    """Memory graph cache.
+
+Usage:
+    graph_cache.py [--verbose] [--mmap] <dump>...
+    graph_cache.py (--help | --version)
+
+Options:
+    <dump>        The memory dump files.
+    -m --mmap     Memory-maps the .core files instead of reading them.
+    -h --help     Shows this message.
+    -v --verbose  Shows details.
+    --version     Shows the current version.
+    """
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    # checking arguments
+    if args['--verbose']:
+        print(args)
+    return args['<dump>'], args['--mmap'], args['--verbose']
+
+
+def main(argv=None):
+    dumpfiles, mmapped, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    for dumpfile in dumpfiles:
+        dump = memorydump.load_memory_dump(dumpfile, mmapped)
+        graph = cached_graph(dump)
+        print('{}: {} nodes, {} edges'.format(dumpfile, len(graph),
+                                              graph.number_of_edges()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,23 +7,26 @@ Author: David I. Urbina
 
 # imports
 from __future__ import print_function
+from collections import deque
+import copy
+from itertools import islice, izip
 import logging
+import multiprocessing as mp
 import sys
 
 from docopt import docopt
 import matplotlib.pyplot as plt
 import networkx as nx
 
+from graph_generator import DataStructure
 from keyedset import KeyedSet
 from segments import Stack
-import graph_generator
+import graph_cache
 import memorydump
 
 
 # constants
 __version__ = 1.0
-search_paths = nx.all_shortest_paths
-# search_paths = nx.all_simple_paths
 
 # exception classes
 
@@ -31,107 +34,204 @@ search_paths = nx.all_shortest_paths
 # interface functions
 
 def diff_memory_graphs(graphs, neggraph=None):
-    diffing = _diff_memory_graphs(graphs)
-
-    if neggraph:
-        intersec2 = _diff_memory_graphs([graphs[-1], neggraph])
-
+    """Returns the (changed, removed, added) nodes of the graphs. The
+    changed and added nodes also present in the negative graph
+    neggraph are left out.
+    """
+    diffing, _ = fold_memory_graphs(graphs)
+    if neggraph is not None:
+        diffing = remove_negative_nodes(diffing, neggraph)
     return diffing
 
 
-def extract_diff_graph(graph, diff):
-    diff_graph = graph.copy()
-    diff_graph.root_nodes = list()
+def remove_negative_nodes(diffing, neggraph):
+    """Returns the (changed, removed, added) nodes without the changed
+    and added nodes that are also in the negative graph, that is, with
+    the same address, size and contents.
+    """
+    negative = set(neggraph.nodes())
+    changed, removed, added = diffing
+    result = (set(n for n in changed if n not in negative), removed,
+              set(n for n in added if n not in negative))
+    logging.debug('{} nodes in the negative graph'.format(
+        len(changed) + len(added) - len(result[0]) - len(result[2])))
+    return result
+
+
+def fold_memory_graphs(graphs):
+    """Diffs each consecutive pair of graphs and folds the result into
+    running changed, removed and added sets. graphs can be any iterable;
+    only the nodes of the previous graph are kept, and the running sets
+    hold copies of the nodes detached from their memory dumps, so each
+    graph and its dump can be released once it has been folded in.
+
+    Returns the (changed, removed, added) sets and the last graph. The
+    changed and added nodes are nodes of the last graph; the removed
+    nodes are detached copies.
+    """
+    graphs = iter(graphs)
+    graph = next(graphs, None)
+    nodes = set(graph.nodes()) if graph is not None else set()
+    pairs = 0
+    for graph in graphs:
+        previous_nodes, nodes = nodes, set(graph.nodes())
+        diff = [map(_detached, d)
+                for d in _diff_pair_memory_graphs(previous_nodes, nodes)]
+        del previous_nodes
+        pairs += 1
+        logging.debug('Graph {} folded in'.format(pairs + 1))
+        if pairs == 1:
+            changed = KeyedSet(diff[1], key=str)
+            removed = KeyedSet(diff[2], key=str)
+            added = KeyedSet(diff[3], key=str)
+        else:
+            changed.intersection_update(diff[1])
+            removed.update(diff[2])
+            added.update(diff[3])
+
+    if not pairs:
+        raise ValueError('At least two memory graphs are needed')
+    # the changed and added nodes are taken back from the last graph
+    changed.intersection_update(nodes)
+    if pairs > 1:
+        added.difference_update(removed)
+    added.intersection_update(nodes)
+    if pairs == 1:
+        return (set(changed), set(removed), set(added)), graph
+    return (changed, removed, added), graph
+
+
+def iter_memory_graphs(dumpfiles, mmapped=False, jobs=1):
+    """Loads the memory dumps and yields their graphs one at a time.
+    With more than one job the graphs are built by a pool of worker
+    processes that send back their compact representation.
+    """
+    if jobs <= 1:
+        for d in dumpfiles:
+            yield graph_cache.cached_graph(
+                memorydump.load_memory_dump(d, mmapped))
+        return
+    pool = mp.Pool(jobs)
+    try:
+        packed = pool.imap(_packed_memory_graph,
+                           [(d, mmapped) for d in dumpfiles])
+        for (d, p) in izip(dumpfiles, packed):
+            yield graph_cache.unpack_graph(
+                p, memorydump.load_memory_dump(d, mmapped))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_memory_graphs(dumpfiles, mmapped=False, jobs=1):
+    """Loads the memory dumps and returns their graphs.
+    """
+    return list(iter_memory_graphs(dumpfiles, mmapped, jobs))
+
 
-    #     pnodes = collections.defaultdict(set)
-    #     for m in diff[0] | diff[2]:
-    #         for n in diff_graph.nodes():
-    #             if nx.has_path(diff_graph, n, m):
-    #                 pnodes[m].add(n)
-    #
-    #     nodes = set.union(*pnodes.values())
-    nodes = set()
+def extract_diff_graph(graph, diff, shortest=False):
+    """Returns the subgraph of the nodes on paths from the root nodes
+    to the changed and added nodes, colored by kind of difference,
+    and exports it to diff_graph.dot. If shortest is True only the
+    nodes on shortest paths are kept.
+    """
     logging.debug('Searching on-paths nodes...')
-    for m in graph.root_nodes:
-        for i in diff[0] | diff[2]:
-            if m == i:
-                nodes.add(m)
-            try:
-                nodes.update(*list(search_paths(diff_graph, m, i)))
-            except:
-                pass
-        if m in nodes:
-            diff_graph.root_nodes.append(m)
+    nodes = on_path_nodes(graph, graph.root_nodes, diff[0] | diff[2],
+                          shortest)
 
     logging.debug('Removing nodes off-path...')
-    for n in diff_graph.nodes()[:]:
-        if n not in nodes:
-            diff_graph.remove_node(n)
+    diff_graph = graph.subgraph(nodes)
+    # the subgraph shares the attribute dictionaries with graph
+    diff_graph.graph = dict(graph.graph)
+    for n in diff_graph:
+        diff_graph.node[n] = dict(graph.node[n])
+    diff_graph.root_nodes = [m for m in graph.root_nodes if m in nodes]
     logging.debug('Setting node colors...')
-    for n in diff_graph.nodes():
+    for n in diff_graph:
         diff_graph.node[n]['color'] = 'turquoise'
     for n in diff[0]:
-        diff_graph.node[n]['color'] = 'red'
-        if isinstance(n, Stack):
-            diff_graph.node[n]['color'] = 'deeppink'
+        if n in diff_graph:
+            diff_graph.node[n]['color'] = 'red'
+            if isinstance(n, Stack):
+                diff_graph.node[n]['color'] = 'deeppink'
     for n in diff[2]:
-        diff_graph.node[n]['color'] = 'green'
+        if n in diff_graph:
+            diff_graph.node[n]['color'] = 'green'
     logging.debug('Exporting diff_graph.dot...')
     nx.write_dot(diff_graph, 'diff_graph.dot')
     return diff_graph
 
+
+def on_path_nodes(graph, sources, targets, shortest=False):
+    """Returns the set of nodes on a path from any of the sources to
+    any of the targets, intersecting a forward traversal from the
+    sources with a reverse traversal from the targets. If shortest
+    is True only the nodes on shortest paths from each source are
+    returned, walking back from the targets over the breadth-first
+    layers of one traversal per source.
+    """
+    sources = [n for n in sources if n in graph]
+    targets = set(targets)
+    if shortest:
+        nodes = set()
+        for n in sources:
+            distances = _distances(graph.successors_iter, [n])
+            nodes.update(_shortest_path_nodes(
+                graph, distances, targets.intersection(distances)))
+        return nodes
+    distances = _distances(graph.successors_iter, sources)
+    return set(_distances(graph.predecessors_iter,
+                          targets.intersection(distances))).intersection(
+        distances)
+
+
 # internal classes
 
 
 # internal functions
 
-def _diff_memory_graphs(graphs):
+def _distances(neighbors, sources):
+    """Returns the breadth-first distance of the nodes reachable from
+    any of the sources following neighbors.
+    """
+    distances = dict.fromkeys(sources, 0)
+    queue = deque(distances)
+    while queue:
+        n = queue.popleft()
+        for m in neighbors(n):
+            if m not in distances:
+                distances[m] = distances[n] + 1
+                queue.append(m)
+    return distances
+
+
+def _shortest_path_nodes(graph, distances, targets):
+    """Walks back from the targets through the predecessors one
+    layer closer to the sources.
+    """
+    nodes = set(targets)
+    queue = deque(nodes)
+    while queue:
+        n = queue.popleft()
+        layer = distances[n] - 1
+        for m in graph.predecessors_iter(n):
+            if m not in nodes and distances.get(m) == layer:
+                nodes.add(m)
+                queue.append(m)
+    return nodes
 
-#     pool = mp.Pool()
-    pairs = []
-    for i in xrange(len(graphs) - 1):
-        pairs.append((graphs[i], graphs[i + 1]))
 
-    diffing = map(_diff_pair_memory_graphs, pairs)
+def _packed_memory_graph(job):
+    dumpfile, mmapped = job
+    dump = memorydump.load_memory_dump(dumpfile, mmapped)
+    return graph_cache.pack_graph(graph_cache.cached_graph(dump, True))
 
-    if len(diffing) == 1:
-    #         _draw_graph_diffing(graphs[0], graphs[1], diffing[0])
-        return (diffing[0][1], diffing[0][2], diffing[0][3])
-    else:
-        keyedsets1 = list()
-        keyedsets2 = list()
-        keyedsets3 = list()
-        for diff in diffing:
-            keyedsets1.append(KeyedSet(diff[1], key=lambda seg: str(seg)))
-            keyedsets2.append(KeyedSet(diff[2], key=lambda seg: str(seg)))
-            keyedsets3.append(KeyedSet(diff[3], key=lambda seg: str(seg)))
-
-        changed = keyedsets1[0]
-        for ks in keyedsets1:
-            changed = changed & ks
-
-        removed = keyedsets2[0]
-        for ks in keyedsets2:
-            removed = removed | ks
-
-        added = keyedsets3[0]
-        for ks in keyedsets3:
-            added = added | ks
-
-        added = added - removed
-        last_md = set(graphs[-1].nodes())
-        added = added & KeyedSet(last_md, key=lambda seg: str(seg))
-
-    return changed, removed, added
-
-
-def _diff_pair_memory_graphs(graph_tuple):
-    graph1 = graph_tuple[0]
-    graph2 = graph_tuple[1]
-    diff_nodes1 = set(graph1.nodes()) - set(graph2.nodes())
-    diff_nodes2 = set(graph2.nodes()) - set(graph1.nodes())
-    diff_nodes1 = KeyedSet(diff_nodes1, key=lambda buf: str(buf))
-    diff_nodes2 = KeyedSet(diff_nodes2, key=lambda buf: str(buf))
+
+def _diff_pair_memory_graphs(nodes1, nodes2):
+    diff_nodes1 = nodes1 - nodes2
+    diff_nodes2 = nodes2 - nodes1
+    diff_nodes1 = KeyedSet(diff_nodes1, key=str)
+    diff_nodes2 = KeyedSet(diff_nodes2, key=str)
     changed_nodes2 = diff_nodes1 & diff_nodes2
     changed_nodes1 = diff_nodes2 & diff_nodes1
     removed_nodes = diff_nodes1 - changed_nodes1
@@ -142,6 +242,18 @@ def _diff_pair_memory_graphs(graph_tuple):
 #     return set([]), set([]), set([]), set([])
 
 
+def _detached(node):
+    """Returns a copy of a node, with its digest, that does not hold
+    the data of its memory dump.
+    """
+    hash(node)
+    record = copy.copy(node)
+    if isinstance(record, DataStructure):
+        record.source = None
+    record.data = []
+    return record
+
+
 def _draw_graph_diffing(graph1, graph2, differences):
     plt.subplot(121)
     pos = nx.pygraphviz_layout(graph1, prog='dot')
@@ -181,12 +293,15 @@ def _process_cmd_line(argv):
     """Memory graph diffing.
 
 Usage:
-    graph_diffing.py [--verbose] <dump>... [-n <neg_dump>]
+    graph_diffing.py [options] <dump>... [-n <neg_dump>]
     graph_diffing.py (--help | --version)
 
 Options:
     <dump>         The list of positive memory dumps.
     -n <neg_dump>  The negative memory dump.
+    -m --mmap      Memory-maps the .core files instead of reading them.
+    -j --jobs <n>  Number of worker processes [default: 1].
+    -s --shortest  Keeps only the nodes on shortest paths to the changes.
     -h --help      Shows this message.
     -v --verbose   Shows details.
     --version      Shows the current version.
@@ -195,35 +310,41 @@ Options:
     args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
 
     # checking arguments
+    try:
+        args['--jobs'] = int(args['--jobs'])
+    except ValueError:
+        print('Error: Invalid number of jobs', args['--jobs'],
+              file=sys.stderr)
+        sys.exit(1)
+
     if args['--verbose']:
         print(args)
-    return args['<dump>'], args['-n'], args['--verbose']
+    return (args['<dump>'], args['-n'], args['--mmap'], args['--jobs'],
+            args['--shortest'], args['--verbose'])
 
 
 def main(argv=None):
-    dumpfiles, neg_filename, verbose = _process_cmd_line(argv)
+    (dumpfiles, neg_filename, mmapped, jobs, shortest,
+     verbose) = _process_cmd_line(argv)
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
-    logging.debug('Loading positive memory dumps...')
-    dumps = map(memorydump.load_memory_dump, dumpfiles)
-    graphs = map(graph_generator.generate_graph, dumps)
+    logging.debug('Loading memory dumps...')
+    # the negative dump is built along with the positive ones
+    graphs = iter_memory_graphs(dumpfiles + ([neg_filename] if neg_filename
+                                             else []), mmapped, jobs)
+    diffing, graph = fold_memory_graphs(islice(graphs, len(dumpfiles)))
 
     if neg_filename:
-        logging.debug('Loading negative memory dump...')
-        negdump = memorydump.load_memory_dump(neg_filename)
-        neggraph = graph_generator.generate_graph(negdump)
-        diffing = diff_memory_graphs(graphs, neggraph)
-    else:
-        diffing = diff_memory_graphs(graphs)
+        diffing = remove_negative_nodes(diffing, next(graphs))
 
     print('Changed nodes: {}'.format(len(diffing[0])))
     print('Removed nodes: {}'.format(len(diffing[1])))
     print('Added nodes: {}'.format(len(diffing[2])))
 
-    extract_diff_graph(graphs[-1], diffing)
+    extract_diff_graph(graph, diffing, shortest)
     logging.info('diff_graph.dot created')
 
     return 0
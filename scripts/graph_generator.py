@@ -7,15 +7,17 @@ Created on May 2, 2013
 
 # imports
 from __future__ import print_function
-from bisect import bisect_left
+from bisect import bisect_right
+from collections import deque
 import logging
 import struct
 import sys
 
 from docopt import docopt
 import networkx as nx
+import numpy as np
 
-from segments import Segment
+from segments import Module, Segment, Stack
 import memorydump
 
 
@@ -27,9 +29,15 @@ _WORD_SZ_ = 4
 _HEAP_SEG_ = 64
 _USERM_INIT = 0x10000
 _KERNEM_INIT = 0x80000000
+_SCAN_BATCH_WORDS_ = 1 << 20
+_HEAP_SEG_LIST_ = 0x58
+_FIRST_ENTRY_ = 0x20
+_WORD_ = struct.Struct('<I')
+# Size, PreviousSize, SmallTagIndex, Flags, UnusedBytes, SegmentIndex
+_HEAP_ENTRY_ = struct.Struct('<HHBBBB')
 
 _ofa = memorydump.offset_from_address
-_afo = memorydump.address_from_offset
+_afos = memorydump.addresses_from_offsets
 
 # exception classes
 
@@ -37,12 +45,25 @@ _afo = memorydump.address_from_offset
 # interface classes
 
 class DataStructure(Segment):
-    def __init__(self, address, size, offset, data):
+    def __init__(self, address, size, offset, data=None, source=None):
         super(DataStructure, self).__init__(address, size, offset, data)
+        # the payload is a view on source made when first inspected
+        self.source = source if data is None else None
 
     def __cmp__(self, other):
         return cmp(self.address, other.address)
 
+    @property
+    def data(self):
+        if self.source is not None:
+            self._data = buffer(self.source, self.offset, self.size)
+            self.source = None
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
 
 class Pointer(object):
     def __init__(self, src, dest, offset_src, offset_dest):
@@ -61,17 +82,198 @@ class Pointer(object):
 
 class MemoryGraph(nx.DiGraph):
     '''Represents a memory graph form by data structures and pointers.
+    Nodes are looked up by address in an interval index that is built
+    on first use and dropped whenever nodes are added or removed.
     '''
+    _index = None
 
     def seek_node_by_address(self, address):
-        for n in self.nodes():
-            if n.address == address:
-                return n
+        '''Returns the node starting at or containing an address, or
+        None if no node does.
+        '''
+        starts, ends, nodes = self._node_index()[:3]
+        i = bisect_right(starts, address) - 1
+        if i >= 0 and (address < ends[i] or address == starts[i]):
+            return nodes[i]
+
+    def seek_nodes_by_addresses(self, addresses):
+        '''Returns the list of nodes starting at or containing each of
+        an array of addresses, with None for the addresses outside
+        every node.
+        '''
+        nodes, starts, ends = self._node_index()[2:]
+        addresses = np.asarray(addresses, dtype=np.int64)
+        if not len(nodes):
+            return [None] * len(addresses)
+        i = np.searchsorted(starts, addresses, side='right') - 1
+        j = np.maximum(i, 0)
+        found = (i >= 0) & ((addresses < ends[j]) | (addresses == starts[j]))
+        return [nodes[k] if f else None
+                for (k, f) in zip(j.tolist(), found.tolist())]
+
+    def add_node(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).add_node(*args, **kwargs)
+
+    def add_nodes_from(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).add_nodes_from(*args, **kwargs)
+
+    def remove_node(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).remove_node(*args, **kwargs)
+
+    def remove_nodes_from(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).remove_nodes_from(*args, **kwargs)
+
+    def add_edge(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).add_edge(*args, **kwargs)
+
+    def add_edges_from(self, *args, **kwargs):
+        self._index = None
+        super(MemoryGraph, self).add_edges_from(*args, **kwargs)
+
+    def clear(self):
+        self._index = None
+        super(MemoryGraph, self).clear()
+
+    def _node_index(self):
+        '''Returns the nodes sorted by address, with their starts and
+        ends as lists and as arrays.
+        '''
+        if self._index is None or len(self._index[2]) != len(self):
+            nodes = sorted(self.nodes_iter(), key=lambda n: n.address)
+            starts = np.array([n.address for n in nodes], dtype=np.int64)
+            ends = starts + np.array([n.size for n in nodes], dtype=np.int64)
+            self._index = (starts.tolist(), ends.tolist(), nodes, starts,
+                           ends)
+        return self._index
+
+
+class NodeKind:
+    DataStructure = 0
+    Module = 1
+    Stack = 2
+
+
+class CompactMemoryGraph(object):
+    '''Represents a memory graph as arrays. Nodes are integer ids
+    with parallel address, size, offset and kind arrays. Edges are
+    kept sorted by source in compressed sparse row form: the edges
+    of node n are at positions indptr[n] to indptr[n + 1] of the
+    src, dest, offset_src and offset_dest arrays.
+    '''
+
+    def __init__(self, dump, address, size, offset, kind, src, dest,
+                 offset_src, offset_dest):
+        self.dump = dump
+        self.address = np.asarray(address, dtype=np.int64)
+        self.size = np.asarray(size, dtype=np.int64)
+        self.offset = np.asarray(offset, dtype=np.int64)
+        self.kind = np.asarray(kind, dtype=np.uint8)
+        src = np.asarray(src, dtype=np.int64)
+        dest = np.asarray(dest, dtype=np.int64)
+        order = np.lexsort((dest, src))
+        self.src = src[order]
+        self.dest = dest[order]
+        self.offset_src = np.asarray(offset_src, dtype=np.int64)[order]
+        self.offset_dest = np.asarray(offset_dest, dtype=np.int64)[order]
+        self.indptr = np.searchsorted(self.src,
+                                      np.arange(len(self.address) + 1))
+        self.root_nodes = np.flatnonzero(self.kind != NodeKind.DataStructure)
+
+    def __len__(self):
+        return len(self.address)
+
+    def number_of_nodes(self):
+        return len(self.address)
+
+    def number_of_edges(self):
+        return len(self.src)
+
+    def successors(self, node):
+        return self.dest[self.indptr[node]:self.indptr[node + 1]]
+
+    def reachable(self, sources):
+        '''Returns a mask of the nodes reachable from the sources.
+        '''
+        reached = np.zeros(len(self.address), dtype=bool)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        reached[frontier] = True
+        while len(frontier):
+            starts = self.indptr[frontier]
+            positions = _concatenated_ranges(
+                starts, self.indptr[frontier + 1] - starts)
+            frontier = np.unique(self.dest[positions])
+            frontier = frontier[~reached[frontier]]
+            reached[frontier] = True
+        return reached
+
+    def subgraph(self, mask):
+        '''Returns the graph induced by the nodes selected by mask.
+        '''
+        ids = np.cumsum(mask) - 1
+        edges = mask[self.src] & mask[self.dest]
+        return CompactMemoryGraph(self.dump, self.address[mask],
+                                  self.size[mask], self.offset[mask],
+                                  self.kind[mask], ids[self.src[edges]],
+                                  ids[self.dest[edges]],
+                                  self.offset_src[edges],
+                                  self.offset_dest[edges])
+
+    def to_memory_graph(self):
+        '''Exports the graph as a MemoryGraph whose nodes are the
+        data structures, modules and stacks of the memory dump.
+        '''
+        dump = self.dump
+        roots = dict(((_node_kind(s), s.address), s)
+                     for s in dump.modules + dump.stacks)
+        nodes = list()
+        for (a, s, o, k) in zip(self.address.tolist(), self.size.tolist(),
+                                self.offset.tolist(), self.kind.tolist()):
+            if k == NodeKind.DataStructure:
+                nodes.append(DataStructure(a, s, o, source=dump.data))
+            elif (k, a) in roots:
+                nodes.append(roots[(k, a)])
+            else:
+                raise ValueError('Root {:#08x} not in {}'.format(a,
+                                                                 dump.name))
+        graph = MemoryGraph()
+        graph.add_nodes_from([n for n in nodes
+                              if isinstance(n, DataStructure)],
+                             color='orange', style='filled')
+        graph.add_edges_from([(nodes[u], nodes[v],
+                               {'label': Pointer(nodes[u], nodes[v], osrc, odest)})
+                              for (u, v, osrc, odest) in zip(
+                self.src.tolist(), self.dest.tolist(),
+                self.offset_src.tolist(), self.offset_dest.tolist())])
+        graph.add_nodes_from(dump.modules, color='blue', style='filled')
+        graph.add_nodes_from(dump.stacks, color='purple', style='filled')
+        graph.root_nodes = list(set(dump.modules) | set(dump.stacks))
+        return graph
+
+    @classmethod
+    def from_memory_graph(cls, graph, dump=None):
+        '''Builds the compact form of a MemoryGraph.
+        '''
+        nodes = graph.nodes()
+        index = dict((n, i) for (i, n) in enumerate(nodes))
+        edges = graph.edges(data=True)
+        return cls(dump, [n.address for n in nodes], [n.size for n in nodes],
+                   [n.offset for n in nodes], [_node_kind(n) for n in nodes],
+                   [index[u] for (u, _, _) in edges],
+                   [index[v] for (_, v, _) in edges],
+                   [d['label'].offset_src for (_, _, d) in edges],
+                   [d['label'].offset_dest for (_, _, d) in edges])
 
 
 # interface functions
 
 def export_memory_graph(filename, graph):
+    if isinstance(graph, CompactMemoryGraph):
+        graph = graph.to_memory_graph()
     nx.write_dot(graph, '{}.dot'.format(filename))
     logging.debug('{}.dot created'.format(filename))
 
@@ -84,14 +286,15 @@ def generate_graph(dump):
     Returns the memory graph.
     """
     graph = MemoryGraph()
-    data_structures = _parse_all_data_structures(dump)
-    logging.debug('{} Data structures parsed'.format(len(data_structures)))
-    graph.add_nodes_from(data_structures, color='orange', style='filled')
-    global_pointers = _find_global_pointers(dump, data_structures)
+    ds_index = _DataStructureIndex(dump, *_parse_all_data_structures(dump))
+    logging.debug('{} Data structures parsed'.format(len(ds_index)))
+    graph.add_nodes_from(ds_index.data_structures, color='orange',
+                         style='filled')
+    global_pointers = _find_global_pointers(dump, ds_index)
     logging.debug('{} Global pointers found'.format(len(global_pointers)))
-    stack_pointers = _find_stack_pointers(dump, data_structures)
+    stack_pointers = _find_stack_pointers(dump, ds_index)
     logging.debug('{} Stack pointers found'.format(len(stack_pointers)))
-    ds_pointers = _find_data_structure_pointers(data_structures)
+    ds_pointers = _find_data_structure_pointers(dump, ds_index)
     logging.debug('{} Data structure pointers found'.format(len(ds_pointers)))
     graph.add_edges_from([(p.src, p.dest, {'label': p})
                           for p in global_pointers])
@@ -103,15 +306,51 @@ def generate_graph(dump):
     graph.add_nodes_from(dump.stacks, color='purple', style='filled')
     graph.root_nodes = list(set(dump.modules) | set(dump.stacks))
     sizeg = sum([n.size for n in graph.nodes()])
-    removed = _remove_unreachable_nodes(graph)
-    sizeg2 = sum([n.size for n in graph.nodes()])
+    removed, removed_size = _remove_unreachable_nodes(graph)
+    sizeg2 = sizeg - removed_size
     logging.debug("Sizes (KB): {} {} {}".format(dump.size / 1024, sizeg / 1024, sizeg2 / 1024))
-    logging.debug('{} Unreachable nodes removed'.format(removed))
+    logging.debug('{} Unreachable nodes removed ({} KB)'.format(
+        removed, removed_size / 1024))
     logging.debug('{} #nodes - {} #edges'.format(len(graph.nodes()),
                                                  len(graph.edges())))
     return graph
 
 
+def generate_compact_graph(dump):
+    """Builds the same graph as generate_graph but as a
+    CompactMemoryGraph, without node or pointer objects.
+
+    Returns the compact memory graph.
+    """
+    ds_index = _DataStructureIndex(dump, *_parse_all_data_structures(dump))
+    logging.debug('{} Data structures parsed'.format(len(ds_index)))
+    roots = dump.modules + dump.stacks
+    nds = len(ds_index)
+    edges = list()
+    for (i, r) in enumerate(roots):
+        offsets, targets, target_offsets = _scan_segment_pointers(r, ds_index)
+        edges.append((np.repeat(nds + i, len(targets)), targets, offsets,
+                      target_offsets))
+    edges.extend(_scan_data_structure_pointers(dump, ds_index))
+    src, dest, offset_src, offset_dest = _unique_edges(
+        [np.concatenate(e) for e in zip(*edges)] if edges
+        else [np.empty(0, dtype=np.int64)] * 4)
+    logging.debug('{} Pointers found'.format(len(src)))
+    graph = CompactMemoryGraph(
+        dump, np.concatenate((ds_index.starts, [r.address for r in roots])),
+        np.concatenate((ds_index.sizes, [r.size for r in roots])),
+        np.concatenate((ds_index.offsets, [r.offset for r in roots])),
+        [NodeKind.DataStructure] * nds + [_node_kind(r) for r in roots],
+        src, dest, offset_src, offset_dest)
+    reachable = graph.reachable(graph.root_nodes)
+    logging.debug('{} Unreachable nodes removed ({} KB)'.format(
+        len(graph) - reachable.sum(), graph.size[~reachable].sum() / 1024))
+    graph = graph.subgraph(reachable)
+    logging.debug('{} #nodes - {} #edges'.format(len(graph),
+                                                 graph.number_of_edges()))
+    return graph
+
+
 # internal classes
 
 class _HeapEntryFlags:
@@ -119,145 +358,266 @@ class _HeapEntryFlags:
     END = 0x10
 
 
+class _DataStructureIndex(object):
+    '''Allocation table of the data structures sorted by address,
+    used to resolve pointer candidates in bulk.
+    '''
+
+    def __init__(self, dump, addresses, sizes, offsets):
+        order = np.argsort(addresses, kind='mergesort')
+        self.dump = dump
+        self.starts = addresses[order]
+        self.sizes = sizes[order]
+        self.offsets = offsets[order]
+        self.ends = self.starts + self.sizes
+        self._data_structures = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def data_structures(self):
+        '''The DataStructure objects, created on first use.
+        '''
+        if self._data_structures is None:
+            self._data_structures = [
+                DataStructure(a, s, o, source=self.dump.data)
+                for (a, s, o) in zip(self.starts.tolist(),
+                                     self.sizes.tolist(),
+                                     self.offsets.tolist())]
+        return self._data_structures
+
+    def resolve(self, words):
+        '''Returns the positions of the words that point into a data
+        structure and the indices of those data structures.
+        '''
+        words = words.astype(np.int64)
+        candidates = np.flatnonzero((words >= _USERM_INIT) &
+                                    (words < _KERNEM_INIT) &
+                                    (words % _WORD_SZ_ == 0))
+        if not len(self.starts):
+            return candidates[:0], candidates[:0]
+        values = words[candidates]
+        targets = np.searchsorted(self.starts, values, side='right') - 1
+        found = (targets >= 0) & (values < self.ends[targets])
+        return candidates[found], targets[found]
+
+
 # internal functions
 
 def _parse_all_data_structures(dump):
     """Parses the Heap segments present in the memory dump
-    and creates a list of allocated data structures.
+    and returns the allocation table of the data structures
+    as address, size and offset arrays.
     """
-    data_structures = []
-    for heap in dump.heaps:
-        data_structures.extend(_parse_heap_data_structures(dump, heap))
-
-    return data_structures
+    tables = [_parse_heap_data_structures(dump, heap) for heap in dump.heaps]
+    if not tables:
+        return [np.empty(0, dtype=np.int64)] * 3
+    return [np.concatenate(t) for t in zip(*tables)]
 
 
 def _parse_heap_data_structures(dump, heap):
-    data_structures = list()
-    for i in xrange(heap.offset + 0x58, heap.offset + 0x58 +
-            (_HEAP_SEG_ * _WORD_SZ_), _WORD_SZ_):
-        seg_address = struct.unpack('<I', dump.data[i:i + _WORD_SZ_])[0]
-        if seg_address != 0:
-            seg_offset = _ofa(dump, seg_address)
-            heap_entries = _parse_heap_segment_entries(dump, seg_offset)
-            data_structures.extend(
-                [DataStructure(_afo(dump, o), s, o, dump.data[o: o + s])
-                 for (o, s) in heap_entries])
-        else:
+    offsets = list()
+    sizes = list()
+    for i in xrange(_HEAP_SEG_):
+        seg_address = _WORD_.unpack_from(dump.data, heap.offset +
+                                         _HEAP_SEG_LIST_ + i * _WORD_SZ_)[0]
+        if seg_address == 0:
             break
-    return data_structures
+        seg_offsets, seg_sizes = _parse_heap_segment_entries(
+            dump, _ofa(dump, seg_address))
+        offsets.extend(seg_offsets)
+        sizes.extend(seg_sizes)
+    offsets = np.array(offsets, dtype=np.int64)
+    return (_afos(dump, offsets), np.array(sizes, dtype=np.int64), offsets)
 
 
 def _parse_heap_segment_entries(dump, segment_offset):
-    """Parse all the HEAP_ENTRY's starting at the given offset
-    and appends a new data structure per HEAP_ENTRY.
+    """Walks the HEAP_ENTRY's of the heap segment at the given
+    offset. Returns the offsets and sizes of the data structures
+    of the used entries.
     """
-    fe = struct.unpack('<I',
-                       dump.data[segment_offset + 0x20: segment_offset + 0x20 + 4])[0]
-    feo = _ofa(dump, fe)
-    heap_entries = []
-    last = False
-    while not last:
-        # current size
-        csize = struct.unpack('<H', dump.data[feo:feo + 2])[0]
-        # previous size
-        #         psize = struct.unpack('<H', dump.data[feo + 2:feo + 4])[0
-        # flags
-        flags = struct.unpack('<B', dump.data[feo + 5:feo + 6])[0]
-        # unused bytes
-        ubytes = struct.unpack('<B', dump.data[feo + 6:feo + 7])[0]
-        # data structure offset
-        offset = feo + _ALLOC_UNIT_SZ_
-        # data structure size
-        size = (csize * _ALLOC_UNIT_SZ_) - ubytes
+    data = dump.data
+    unpack_entry = _HEAP_ENTRY_.unpack_from
+    feo = _ofa(dump, _WORD_.unpack_from(data,
+                                        segment_offset + _FIRST_ENTRY_)[0])
+    offsets = list()
+    sizes = list()
+    while True:
+        csize, _, _, flags, ubytes, _ = unpack_entry(data, feo)
         if flags & _HeapEntryFlags.USED:
-            heap_entries.append((offset, size))
+            offsets.append(feo + _ALLOC_UNIT_SZ_)
+            sizes.append(csize * _ALLOC_UNIT_SZ_ - ubytes)
+        if flags & _HeapEntryFlags.END:
+            break
+        if csize == 0:
+            logging.warning('Corrupted HEAP_ENTRY at offset {:#08x}'.format(
+                feo))
+            break
         feo += csize * _ALLOC_UNIT_SZ_
-        last = flags & _HeapEntryFlags.END
-    return heap_entries
-
+    return offsets, sizes
 
-def _search_data_structure_with_address(data_structures, address):
-    """Implements binary search over the list of data structures.
-    """
-    index = bisect_left(data_structures, DataStructure(address, 0, 0, []))
-    ds = data_structures[index - 1]
-    if ds.address <= address < ds.address + ds.size:
-        return ds
-    if index < len(data_structures):
-        ds = data_structures[index]
-        if ds.address <= address < ds.address + ds.size:
-            return ds
 
-
-def _find_global_pointers(dump, data_structures):
+def _find_global_pointers(dump, ds_index):
     """Returns the list of global pointers making use of
     the global ranges.
     """
     global_pointers = list()
-    sorted(data_structures, key=lambda ds: ds.address)
     for m in dump.modules:
-        for (w, o) in m.walk_by_word():
-            if _USERM_INIT <= w < _KERNEM_INIT:
-                ds = _search_data_structure_with_address(data_structures, w)
-                if w % _WORD_SZ_ == 0 and ds:
-                    global_pointers.append(Pointer(m, ds, o, w - ds.address))
+        global_pointers.extend(_find_segment_pointers(m, ds_index))
     return global_pointers
 
 
-def _find_stack_pointers(dump, data_structures):
+def _find_stack_pointers(dump, ds_index):
     """Returns the list of stack pointers making use of
     the stack ranges.
     """
     stack_pointers = list()
     for s in dump.stacks:
-        for (w, o) in s.walk_by_word():
-            if _USERM_INIT <= w < _KERNEM_INIT:
-                ds = _search_data_structure_with_address(data_structures, w)
-                if w % _WORD_SZ_ == 0 and ds:
-                    stack_pointers.append(Pointer(s, ds, o, w - ds.address))
+        stack_pointers.extend(_find_segment_pointers(s, ds_index))
     return stack_pointers
 
 
-def _find_data_structure_pointers(data_structures):
-    """Returns the list of stack pointers making use of
-    the stack ranges.
+def _find_data_structure_pointers(dump, ds_index):
+    """Returns the list of pointers between data structures.
     """
     ds_pointers = list()
-    for ds in data_structures:
-        for (w, o) in ds.walk_by_word():
-            if _USERM_INIT <= w < _KERNEM_INIT:
-                ds2 = _search_data_structure_with_address(data_structures, w)
-                if w % _WORD_SZ_ == 0 and ds2 and ds != ds2:
-                    ds_pointers.append(Pointer(ds, ds2, o, w - ds2.address))
+    data_structures = ds_index.data_structures
+    for (srcs, targets, offsets, target_offsets) in \
+            _scan_data_structure_pointers(dump, ds_index):
+        for (s, t, o, to) in zip(srcs.tolist(), targets.tolist(),
+                                 offsets.tolist(), target_offsets.tolist()):
+            ds_pointers.append(Pointer(data_structures[s],
+                                       data_structures[t], o, to))
     return ds_pointers
 
 
+def _find_segment_pointers(segment, ds_index):
+    """Returns the list of pointers from the words of a module
+    or stack to the data structures.
+    """
+    data_structures = ds_index.data_structures
+    offsets, targets, target_offsets = _scan_segment_pointers(segment,
+                                                              ds_index)
+    return [Pointer(segment, data_structures[t], o, to)
+            for (o, t, to) in zip(offsets.tolist(), targets.tolist(),
+                                  target_offsets.tolist())]
+
+
+def _scan_segment_pointers(segment, ds_index):
+    """Returns the offsets of the pointer words of a module or
+    stack, the indices of the data structures they point to and
+    the offsets within them.
+    """
+    words, offsets = segment.words()
+    found, targets = ds_index.resolve(words)
+    return (offsets[found], targets,
+            words[found].astype(np.int64) - ds_index.starts[targets])
+
+
+def _scan_data_structure_pointers(dump, ds_index):
+    """Yields the pointers between data structures as arrays of
+    source indices, target indices, source offsets and target
+    offsets. The words of the data structures are gathered from
+    the dump's data and resolved in batches.
+    """
+    raw = np.frombuffer(dump.data, dtype=np.uint8)
+    offsets = ds_index.offsets
+    counts = ds_index.sizes / _WORD_SZ_
+    for (first, last) in _scan_batches(counts):
+        batch_counts = counts[first:last]
+        srcs = np.repeat(np.arange(first, last), batch_counts)
+        word_offsets = (_concatenated_ranges(np.zeros_like(batch_counts),
+                                             batch_counts) * _WORD_SZ_)
+        positions = offsets[srcs] + word_offsets
+        words = raw[positions[:, np.newaxis] +
+                    np.arange(_WORD_SZ_)].view('<u4').ravel()
+        found, targets = ds_index.resolve(words)
+        inner = targets != srcs[found]
+        found, targets = found[inner], targets[inner]
+        yield (srcs[found], targets, word_offsets[found],
+               words[found].astype(np.int64) - ds_index.starts[targets])
+
+
+def _scan_batches(counts):
+    """Splits the data structures in consecutive ranges holding
+    about _SCAN_BATCH_WORDS_ words each.
+    """
+    totals = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        base = totals[first - 1] if first else 0
+        last = np.searchsorted(totals, base + _SCAN_BATCH_WORDS_,
+                               side='right')
+        last = max(int(last), first + 1)
+        yield first, last
+        first = last
+
+
+def _concatenated_ranges(starts, counts):
+    """Returns the concatenation of the ranges of counts[i]
+    integers beginning at starts[i].
+    """
+    firsts = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(firsts.size) - firsts
+
+
+def _unique_edges(edges):
+    """Keeps the last pointer found between each pair of nodes, as
+    adding them to a networkx graph does.
+    """
+    src, dest = edges[0], edges[1]
+    keys = (src * (dest.max() + 1 if len(dest) else 1) + dest)[::-1]
+    _, last = np.unique(keys, return_index=True)
+    keep = np.sort(len(keys) - 1 - last)
+    return [e[keep] for e in edges]
+
+
+def _node_kind(node):
+    if isinstance(node, Module):
+        return NodeKind.Module
+    elif isinstance(node, Stack):
+        return NodeKind.Stack
+    return NodeKind.DataStructure
+
+
 def _remove_unreachable_nodes(graph):
     """Remove all data structures that are not reachable
     from modules or from stacks.
+
+    Returns the number of nodes and of bytes removed.
+    """
+    reachable = _reachable_nodes(graph, graph.root_nodes)
+    unreachable = [n for n in graph.nodes_iter() if n not in reachable]
+    graph.remove_nodes_from(unreachable)
+    return len(unreachable), sum(n.size for n in unreachable)
+
+
+def _reachable_nodes(graph, sources):
+    """Returns the set of nodes reachable from any of the sources
+    using a single breadth-first traversal.
     """
-    removed = 0
-    for node in graph.nodes()[:]:
-        # check if reachable from globals
-        for root in graph.root_nodes:
-            if nx.has_path(graph, root, node):
-                break
-        else:
-            graph.remove_node(node)
-            removed += 1
-    return removed
+    reachable = set(sources)
+    queue = deque(reachable)
+    while queue:
+        for n in graph.successors_iter(queue.popleft()):
+            if n not in reachable:
+                reachable.add(n)
+                queue.append(n)
+    return reachable
 
 
 def _process_cmd_line(argv):
     """Memory graph generator.
 
 Usage:
-    graph_generator.py [--verbose] <dump>
+    graph_generator.py [--verbose] [--mmap] [--compact] <dump>
     graph_generator.py (--help | --version)
 
 Options:
     <dump>        The memory dump file.
+    -m --mmap     Memory-maps the .core file instead of reading it.
+    -c --compact  Builds the graph with the array-backed backend.
     -h --help     Shows this message.
     -v --verbose  Shows details.
     --version     Shows the current version.
@@ -268,19 +628,22 @@ Options:
     # checking arguments
     if args['--verbose']:
         print(args)
-    return args['<dump>'], args['--verbose']
+    return args['<dump>'], args['--mmap'], args['--compact'], args['--verbose']
 
 
 def main(argv=None):
-    dumpfile, verbose = _process_cmd_line(argv)
+    dumpfile, mmapped, compact, verbose = _process_cmd_line(argv)
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
     try:
-        dump = memorydump.load_memory_dump(dumpfile)
+        dump = memorydump.load_memory_dump(dumpfile, mmapped)
     except Exception as e:
         logging.error(e)
     logging.debug(dump)
-    graph = generate_graph(dump)
+    if compact:
+        graph = generate_compact_graph(dump)
+    else:
+        graph = generate_graph(dump)
     export_memory_graph(dump.name, graph)
     return 0
 
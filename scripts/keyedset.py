@@ -48,7 +48,7 @@ Copyright (C) 2009 Gabriel A. Genellina
 __author__ = 'Gabriel A. Genellina'
 __version__ = "$Revision: 1.12 $"[11:-2]
 
-from collections import Set, MutableSet
+from collections import Iterable, Set, MutableSet
 
 
 # Abstract classes Set and MutableSet define only the operators (&, &=, etc.)
@@ -71,12 +71,17 @@ def _build_variant(cls, opname):
 
 
 class FrozenKeyedSet(Set):
-    """A frozen set that uses a custom element equality function."""
+    """A frozen set that uses a custom element equality function.
+
+    The key of every element is computed once, when it is added.
+    Operations between keyed sets sharing the same key function work
+    directly on their keys; any other iterable has the key function
+    applied to its elements. As with dictionaries, when both operands
+    hold an element with the same key, the result of an intersection
+    or union holds the element of the right operand.
+    """
 
     # "named" methods like those of frozenset, in addition to operators
-    intersection = _build_variant(Set, '__and__')
-    union = _build_variant(Set, '__or__')
-    difference = _build_variant(Set, '__sub__')
     symmetric_difference = _build_variant(Set, '__xor__')
     issubset = _build_variant(Set, '__le__')
     issuperset = _build_variant(Set, '__ge__')
@@ -95,6 +100,13 @@ class FrozenKeyedSet(Set):
         self._items = dict((key(item), item) for item in iterable)
         self._key = key
 
+    @classmethod
+    def from_pairs(cls, pairs, key=lambda x: x):
+        """Create a FrozenKeyedSet from (key, item) pairs whose keys
+        were already computed with the key function.
+        """
+        return cls._from_items(dict(pairs), key)
+
     # Implementation of abstract methods from the Set ABC
 
     def __iter__(self):
@@ -110,6 +122,39 @@ class FrozenKeyedSet(Set):
     def __len__(self):
         return len(self._items)
 
+    # performance: override implementations in Set, which apply the
+    # key function to every element and go through _from_iterable
+
+    def __and__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.intersection(other)
+
+    def __or__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.union(other)
+
+    def __sub__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.difference(other)
+
+    def intersection(self, *others):
+        """Return the elements whose keys are in every set."""
+        return self._from_items(_intersect(self._items, others, self._keyed),
+                                self._key)
+
+    def union(self, *others):
+        """Return the elements whose keys are in any of the sets."""
+        return self._from_items(_unite(self._items, others, self._keyed),
+                                self._key)
+
+    def difference(self, *others):
+        """Return the elements whose keys are in none of the others."""
+        return self._from_items(_subtract(self._items, others, self._keyed),
+                                self._key)
+
     # NOT a classmethod because self.key must be transferred too!
     # Fortunately it is always called as self._from_iterable(...)
     # in _abccoll.py
@@ -117,7 +162,21 @@ class FrozenKeyedSet(Set):
         return type(self)(iterable, key=self._key)
 
     def copy(self):
-        return type(self)(self._items.values(), key=self._key)
+        return self._from_items(dict(self._items), self._key)
+
+    @classmethod
+    def _from_items(cls, items, key):
+        # builds a set that owns the items dictionary
+        self = cls.__new__(cls)
+        self._items = items
+        self._key = key
+        return self
+
+    def _keyed(self, other):
+        """Return the key to element dictionary of other."""
+        if isinstance(other, FrozenKeyedSet) and other._key is self._key:
+            return other._items
+        return dict((self._key(item), item) for item in other)
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, list(self._items.values()))
@@ -138,9 +197,6 @@ class KeyedSet(FrozenKeyedSet, MutableSet):
     """A mutable set that uses a custom element equality function."""
 
     # "named" methods like those of `set` class, in addition to operators
-    intersection_update = _build_variant(MutableSet, '__iand__')
-    update = _build_variant(MutableSet, '__ior__')
-    difference_update = _build_variant(MutableSet, '__isub__')
     symmetric_difference_update = _build_variant(MutableSet, '__ixor__')
 
     __hash__ = None  # because FrozenKeyedSet implements it
@@ -165,6 +221,58 @@ class KeyedSet(FrozenKeyedSet, MutableSet):
     def clear(self):
         self._items.clear()
 
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def intersection_update(self, *others):
+        """Keep only the elements whose keys are in every set."""
+        self._items = _intersect(self._items, others, self._keyed)
+
+    def update(self, *others):
+        """Add the elements of all the others."""
+        for other in others:
+            self._items.update(self._keyed(other))
+
+    def difference_update(self, *others):
+        """Remove the elements whose keys are in any of the others."""
+        self._items = _subtract(self._items, others, self._keyed)
+
+
+def _intersect(items, others, keyed):
+    for other in others:
+        other = keyed(other)
+        if len(items) < len(other):
+            items = dict((k, other[k]) for k in items if k in other)
+        else:
+            items = dict((k, v) for (k, v) in other.iteritems()
+                         if k in items)
+    return items
+
+
+def _unite(items, others, keyed):
+    # inserting one item at a time keeps the order of Set.__or__
+    items = dict(items.iteritems())
+    for other in others:
+        items.update(keyed(other).iteritems())
+    return items
+
+
+def _subtract(items, others, keyed):
+    for other in others:
+        other = keyed(other)
+        items = dict((k, v) for (k, v) in items.iteritems()
+                     if k not in other)
+    return items
+
 
 # From this point on, only tests.
 # Perhaps there are more test cases than really required,
@@ -293,6 +401,65 @@ class KeyedSetTestCase(TestCase):
         s.symmetric_difference_update(self.lst2)
         self.assertEquals(sorted(x.name for x in s), expected)
 
+    def test_many(self):
+        lst3 = [Foo('Jim'), Foo('Tom'), Foo('Ann')]
+        s = self.s1f.intersection(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s), ['Jim'])
+        s = self.s1f.union(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s),
+                          ['Ann', 'Dan', 'Jim', 'Joe', 'Luc', 'Tom'])
+        s = self.s1f.difference(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s), ['Joe'])
+        s = self.s1.copy()
+        s.intersection_update(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s), ['Jim'])
+        s = self.s1.copy()
+        s.update(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s),
+                          ['Ann', 'Dan', 'Jim', 'Joe', 'Luc', 'Tom'])
+        s = self.s1.copy()
+        s.difference_update(self.s2, lst3)
+        self.assertEquals(sorted(x.name for x in s), ['Joe'])
+
+    def test_right_operand(self):
+        jim = self.lst2[1]
+        for s in (self.s1 & self.s2, self.s1 | self.s2):
+            self.assertTrue(jim in [x for x in s if x.name == 'Jim'])
+        s = self.s1.copy()
+        s &= self.s2
+        self.assertTrue(list(s)[0] is jim)
+        s = self.s1.copy()
+        s.update(self.lst2)
+        self.assertTrue(jim in [x for x in s if x.name == 'Jim'])
+
+    def test_keys_computed_once(self):
+        calls = []
+
+        def key(o):
+            calls.append(o)
+            return o.name
+
+        s1 = KeyedSet(self.lst1, key=key)
+        s2 = FrozenKeyedSet(self.lst2, key=key)
+        del calls[:]
+        s1 & s2, s1 | s2, s1 - s2
+        s1.intersection_update(s2)
+        s1.update(s2)
+        s1.difference_update(s2)
+        self.assertEquals(calls, [])
+
+    def test_from_pairs(self):
+        s = KeyedSet.from_pairs(((o.name, o) for o in self.lst1),
+                                key=lambda o: o.name)
+        self.assertTrue(isinstance(s, KeyedSet))
+        self.assertEquals(s, self.s1)
+        self.assertTrue(Foo('Tom') in s)
+        s.add(Foo('Ann'))
+        self.assertEquals(4, len(s))
+        s = FrozenKeyedSet.from_pairs([('Jim', self.lst2[1])])
+        self.assertTrue(isinstance(s, FrozenKeyedSet))
+        self.assertTrue('Jim' in s)
+
     def test_relations(self):
         self.assertFalse(self.s1f.isdisjoint(self.s2))
         s3 = self.s1 - self.s2
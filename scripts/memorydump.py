@@ -7,16 +7,35 @@ Created on May 2, 2013
 
 # imports
 from __future__ import print_function
+from bisect import bisect_right
 import logging
+import mmap
+import os
+import struct
 import sys
 
 from docopt import docopt
+import numpy as np
 
+from minidump_reader import (MinidumpReader, StreamType, MemoryState,
+                             MemoryType, MemoryProtection, is_stdlib_module)
 import segments
 
 # constants
 
 __version__ = 2.0
+_HEAP_SIGNATURE_ = 0xeeffeeff
+_WORD_ = struct.Struct('<I')
+# binary metadata: header, region records of the segments, heaps,
+# stacks and private data, then module records
+_METADATA_EXT_ = '.meta'
+_METADATA_MAGIC_ = 'SGPM'
+_METADATA_VERSION_ = 1
+_METADATA_HEADER_ = struct.Struct('<4sIIIIII')
+_REGION_DTYPE_ = np.dtype([('address', '<u8'), ('size', '<u8')])
+_MODULE_DTYPE_ = np.dtype([('address', '<u8'), ('size', '<u8'),
+                           ('name', 'S128')])
+_METADATA_FILES_ = ['.segments', '.modules', '.heaps', '.stacks', '.pdata']
 
 # exception classes
 
@@ -29,7 +48,7 @@ class MemoryDump(object):
     '''
 
     def __init__(self, name, modules=None, heaps=None, stacks=None,
-                 private_data=None, segments=None, data=None):
+                 private_data=None, segments=None, data=None, index=None):
         self.name = name
         self.modules = [] if modules is None else modules
         self.stacks = [] if stacks is None else stacks
@@ -38,6 +57,7 @@ class MemoryDump(object):
         self.segments = [] if segments is None else segments
         self.data = [] if data is None else data
         self.size = len(self.data)
+        self.index = SegmentIndex(self.segments) if index is None else index
 
     def __repr__(self):
         return '<md n={} s={}\nmod={}\nhp={}\nst={}\npd={}\nseg={}>'.format(
@@ -48,6 +68,78 @@ class MemoryDump(object):
         return self.__repr__()
 
 
+class SegmentIndex(object):
+    '''
+    Sorted index of the segments of a memory dump that translates
+    virtual addresses to offsets and back with a binary search.
+    Offsets follow the order of the segments in the .core file,
+    from "base" on.
+    '''
+
+    def __init__(self, segments, base=0):
+        sizes = np.array([s.size for s in segments], dtype=np.int64)
+        # by offset
+        self.offsets = base + np.cumsum(sizes) - sizes
+        self.addresses = np.array([s.address for s in segments],
+                                  dtype=np.int64)
+        self.sizes = sizes
+        # by address
+        order = np.argsort(self.addresses, kind='mergesort')
+        self.sorted_addresses = self.addresses[order]
+        self.sorted_offsets = self.offsets[order]
+        self.sorted_sizes = self.sizes[order]
+        self._by_offset = (self.offsets.tolist(), self.addresses.tolist(),
+                           self.sizes.tolist())
+        self._by_address = (self.sorted_addresses.tolist(),
+                            self.sorted_offsets.tolist(),
+                            self.sorted_sizes.tolist())
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def offset(self, address):
+        '''
+        Return the offset corresponding to a virtual address.
+        '''
+        addresses, offsets, sizes = self._by_address
+        i = bisect_right(addresses, address) - 1
+        if i < 0 or address > addresses[i] + sizes[i]:
+            raise ValueError(
+                'No corresponding offset for address: {:#08x}'.format(address))
+        return offsets[i] + address - addresses[i]
+
+    def address(self, offset):
+        '''
+        Return the virtual address corresponding to an offset.
+        '''
+        offsets, addresses, sizes = self._by_offset
+        i = bisect_right(offsets, offset) - 1
+        if i < 0 or offset > offsets[i] + sizes[i]:
+            raise ValueError(
+                'No corresponding address for offset: {:#08x}'.format(offset))
+        return addresses[i] + offset - offsets[i]
+
+    def offsets_of(self, addresses):
+        '''
+        Return the array of offsets corresponding to an array of
+        virtual addresses.
+        '''
+        return _translate(np.asarray(addresses, dtype=np.int64),
+                          self.sorted_addresses, self.sorted_offsets,
+                          self.sorted_sizes, 'No corresponding offset '
+                                             'for address: {:#08x}')
+
+    def addresses_of(self, offsets):
+        '''
+        Return the array of virtual addresses corresponding to an
+        array of offsets.
+        '''
+        return _translate(np.asarray(offsets, dtype=np.int64), self.offsets,
+                          self.addresses, self.sizes, 'No corresponding '
+                                                      'address for offset: '
+                                                      '{:#08x}')
+
+
 # internal classes
 
 class _SegmentType:
@@ -60,10 +152,85 @@ class _SegmentType:
 
 # interface functions
 
-def load_memory_dump(dumpfile):
-    # Reading metadata files
-    data = _read_memory_dump_data(dumpfile + '.core')
+def load_memory_dump(dumpfile, mmapped=False):
+    '''
+    Loads the memory dump "dumpfile" from its .core and metadata
+    files, or straight from the minidump if "dumpfile" is a .dmp
+    file. The metadata is read from the binary .meta file when it
+    is newer than the text files; a stale .meta is ignored with a
+    warning. If "mmapped" is True the .core file is memory-mapped
+    instead of read, so dumps larger than the physical memory can be
+    analysed. In both cases segments share the dump's buffer.
+    '''
+    if dumpfile.endswith('.dmp'):
+        return load_minidump(dumpfile, mmapped)
+    data = _read_memory_dump_data(dumpfile + '.core', mmapped)
     logging.debug('{}.core loaded {} bytes'.format(dumpfile, len(data)))
+    metadata = None
+    if _metadata_up_to_date(dumpfile):
+        try:
+            metadata = read_binary_metadata(dumpfile + _METADATA_EXT_)
+            logging.debug('{}{} loaded'.format(dumpfile, _METADATA_EXT_))
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring {}{}: {}'.format(dumpfile,
+                                                       _METADATA_EXT_, e))
+    elif os.path.exists(dumpfile + _METADATA_EXT_):
+        logging.warning('Ignoring {}{}: older than the text metadata'.format(
+            dumpfile, _METADATA_EXT_))
+    if metadata is None:
+        metadata = read_text_metadata(dumpfile)
+    mseg, mmod, mhp, mstk, mpd = metadata
+    seg = [segments.Segment(a, s) for (a, s) in mseg]
+    return _build_memory_dump(dumpfile, data, seg, SegmentIndex(seg), mmod,
+                              mhp, mstk, mpd)
+
+
+def load_minidump(dumpfile, mmapped=False, all_modules=False):
+    '''
+    Loads the memory dump "dumpfile" straight from a minidump,
+    reading it once. The memory ranges of its Memory64ListStream
+    are the segments, in place. Modules come from the
+    ModuleListStream, without the standard ones unless
+    "all_modules" is True. Stacks are the committed regions
+    holding the thread stacks; heaps and private data are the
+    other committed private regions, heaps being the ones that
+    start with a HEAP header.
+    '''
+    reader = MinidumpReader(dumpfile)
+    try:
+        starts, sizes, offsets = reader.memory_ranges()
+        seg = [segments.Segment(a, s)
+               for (a, s) in zip(starts.tolist(), sizes.tolist())]
+        base = int(offsets[0]) if len(offsets) else 0
+        index = SegmentIndex(seg, base)
+        mmod = list()
+        if StreamType.ModuleListStream in reader.streams:
+            for (a, s, path) in reader.modules():
+                if not all_modules and is_stdlib_module(path):
+                    continue
+                if not _in_dump(index, a, s):
+                    logging.debug('Module {} not in {}'.format(path,
+                                                                dumpfile))
+                    continue
+                mmod.append((a, s, path.split('\\')[-1].encode('utf-8')))
+        mhp, mstk, mpd = _classify_regions(reader, index)
+    finally:
+        if not mmapped:
+            reader.close()
+    if mmapped:
+        data = reader.data
+    else:
+        data = _read_memory_dump_data(dumpfile)
+    logging.debug('{} loaded {} bytes'.format(dumpfile, len(data)))
+    return _build_memory_dump(dumpfile, data, seg, index, mmod, mhp, mstk,
+                              mpd)
+
+
+def read_text_metadata(dumpfile):
+    '''
+    Reads the segments, modules, heaps, stacks and private data of
+    the memory dump "dumpfile" from its text metadata files.
+    '''
     mseg = _read_metadata(_SegmentType.Segment, dumpfile + '.segments')
     logging.debug('{}.segments loaded'.format(dumpfile))
     mmod = _read_metadata(_SegmentType.Module, dumpfile + '.modules')
@@ -76,34 +243,57 @@ def load_memory_dump(dumpfile):
     mpd = _read_metadata(_SegmentType.Pdata, dumpfile + '.pdata')
     logging.debug('{}.pdata loaded'.format(dumpfile))
     #     mpd = []
-    # Creating MemoryDump object
-    seg = [segments.Segment(a, s) for (a, s) in mseg]
-    for s in seg:
-        s.offset = _ofa(seg, a)
-        s.data = data[s.offset:s.offset + s.size]
+    return mseg, mmod, mhp, mstk, mpd
 
-    mod = list()
-
-    for (a, s, n) in mmod:
-        o = _ofa(seg, a)
-        mod.append(segments.Module(n, a, s, o, data[o:o + s]))
-
-    hp = list()
-    for (a, s) in mhp:
-        o = _ofa(seg, a)
-        hp.append(segments.Heap(a, s, o, data[o:o + s]))
-
-    stk = list()
-    for (a, s) in mstk:
-        o = _ofa(seg, a)
-        stk.append(segments.Stack(a, s, o, data[o:o + s]))
-
-    pd = list()
-    for (a, s) in mpd:
-        o = _ofa(seg, a)
-        pd.append(segments.PrivateData(a, s, o, data[o:o + s]))
 
-    return MemoryDump(dumpfile, mod, hp, stk, pd, seg, data)
+def write_binary_metadata(filename, metadata):
+    '''
+    Writes the (segments, modules, heaps, stacks, private data)
+    metadata of a memory dump to the binary file "filename", as
+    fixed-width records after a versioned header.
+    '''
+    mseg, mmod, mhp, mstk, mpd = metadata
+    regions = np.array(mseg + mhp + mstk + mpd, dtype=_REGION_DTYPE_)
+    modules = np.zeros(len(mmod), dtype=_MODULE_DTYPE_)
+    for (i, (a, s, n)) in enumerate(mmod):
+        if len(n) > _MODULE_DTYPE_['name'].itemsize:
+            raise ValueError('Module name too long: {}'.format(n))
+        modules[i] = (a, s, n)
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(_METADATA_HEADER_.pack(_METADATA_MAGIC_, _METADATA_VERSION_,
+                                       len(mseg), len(mmod), len(mhp),
+                                       len(mstk), len(mpd)))
+        f.write(regions.tobytes())
+        f.write(modules.tobytes())
+    os.rename(temp, filename)
+
+
+def read_binary_metadata(filename):
+    '''
+    Reads the (segments, modules, heaps, stacks, private data)
+    metadata of a memory dump from the binary file "filename".
+    '''
+    with open(filename, 'rb') as f:
+        header = f.read(_METADATA_HEADER_.size)
+        if len(header) < _METADATA_HEADER_.size:
+            raise ValueError('Truncated metadata')
+        (magic, version, nseg, nmod, nhp, nstk,
+         npd) = _METADATA_HEADER_.unpack(header)
+        if magic != _METADATA_MAGIC_ or version != _METADATA_VERSION_:
+            raise ValueError('Unknown metadata format')
+        nregions = nseg + nhp + nstk + npd
+        regions = np.fromfile(f, dtype=_REGION_DTYPE_, count=nregions)
+        modules = np.fromfile(f, dtype=_MODULE_DTYPE_, count=nmod)
+    if len(regions) != nregions or len(modules) != nmod:
+        raise ValueError('Truncated metadata')
+    regions = zip(regions['address'].tolist(), regions['size'].tolist())
+    ends = np.cumsum([nseg, nhp, nstk, npd]).tolist()
+    mseg, mhp, mstk, mpd = [regions[start:end] for (start, end)
+                            in zip([0] + ends, ends)]
+    mmod = zip(modules['address'].tolist(), modules['size'].tolist(),
+               modules['name'].tolist())
+    return mseg, mmod, mhp, mstk, mpd
 
 
 def address_from_offset(dump, offset):
@@ -111,7 +301,7 @@ def address_from_offset(dump, offset):
     Return the virtual address corresponding to an offset in
     the memory dump.
     '''
-    return _address_from_offset(dump.segments, offset)
+    return dump.index.address(offset)
 
 
 def offset_from_address(dump, address):
@@ -119,7 +309,23 @@ def offset_from_address(dump, address):
     Return the offset in the memory dump corresponding to a
     virtual address.
     '''
-    return _offset_from_address(dump.segments, address)
+    return dump.index.offset(address)
+
+
+def addresses_from_offsets(dump, offsets):
+    '''
+    Return the array of virtual addresses corresponding to an
+    array of offsets in the memory dump.
+    '''
+    return dump.index.addresses_of(offsets)
+
+
+def offsets_from_addresses(dump, addresses):
+    '''
+    Return the array of offsets in the memory dump corresponding
+    to an array of virtual addresses.
+    '''
+    return dump.index.offsets_of(addresses)
 
 
 def extract_segment_by_address(dump, address):
@@ -138,42 +344,139 @@ def extract_segment_by_address(dump, address):
 
 # internal functions
 
-def _address_from_offset(segments, offset):
+def _metadata_up_to_date(dumpfile):
     '''
-    Return the virtual address corresponding to an offset in
-    the memory dump.
+    Return True if the binary metadata file of "dumpfile" exists and
+    is not older than its text metadata files.
     '''
-    temp_offset = 0
-    for s in segments:
-        if temp_offset + s.size >= offset:
-            return s.address + offset - temp_offset
-        else:
-            temp_offset += s.size
-    raise ValueError(
-        'No corresponding address for offset: {:#08x}'.format(offset))
+    metafile = dumpfile + _METADATA_EXT_
+    if not os.path.exists(metafile):
+        return False
+    mtime = os.path.getmtime(metafile)
+    return all(os.path.getmtime(dumpfile + ext) <= mtime
+               for ext in _METADATA_FILES_
+               if os.path.exists(dumpfile + ext))
 
 
-def _offset_from_address(segments, address):
+def _build_memory_dump(name, data, seg, index, mmod, mhp, mstk, mpd):
     '''
-    Return the offset in the memory dump corresponding to a
-    virtual address.
+    Creates the MemoryDump object over "data" from the (address,
+    size) metadata of its segments, heaps, stacks and private data,
+    and the (address, size, name) metadata of its modules.
+    '''
+    for s in seg:
+        s.offset = index.offset(s.address)
+        s.data = _data_view(data, s.offset, s.size)
+
+    mod = list()
+
+    for (a, s, n) in mmod:
+        o = index.offset(a)
+        mod.append(segments.Module(n, a, s, o, _data_view(data, o, s)))
+
+    hp = list()
+    for (a, s) in mhp:
+        o = index.offset(a)
+        hp.append(segments.Heap(a, s, o, _data_view(data, o, s)))
+
+    stk = list()
+    for (a, s) in mstk:
+        o = index.offset(a)
+        stk.append(segments.Stack(a, s, o, _data_view(data, o, s)))
+
+    pd = list()
+    for (a, s) in mpd:
+        o = index.offset(a)
+        pd.append(segments.PrivateData(a, s, o, _data_view(data, o, s)))
+
+    return MemoryDump(name, mod, hp, stk, pd, seg, data, index)
+
+
+def _classify_regions(reader, index):
     '''
-    temp_offset = 0
-    for s in segments:
-        if s.address <= address:
-            if s.address + s.size >= address:
-                return temp_offset + address - s.address
-            else:
-                temp_offset += s.size
+    Returns the (address, size) of the heaps, stacks and private
+    data of a minidump that are present in its memory ranges.
+    Without a MemoryInfoListStream only the thread stacks are known.
+    '''
+    stacks = list()
+    if StreamType.ThreadListStream in reader.streams:
+        threads = reader.threads()
+        stacks = zip(threads['stack_start'].tolist(),
+                     threads['stack_size'].tolist())
+    if StreamType.MemoryInfoListStream not in reader.streams:
+        return [], [r for r in stacks if _in_dump(index, *r)], []
+    info = reader.memory_info()
+    regions = [(a, s) for (a, s, state, protect, type_)
+               in zip(info['base'].tolist(), info['region_size'].tolist(),
+                      info['state'].tolist(), info['protect'].tolist(),
+                      info['type'].tolist())
+               if state == MemoryState.MEM_COMMIT and
+               type_ == MemoryType.MEM_PRIVATE and
+               not protect & (MemoryProtection.PAGE_NOACCESS |
+                              MemoryProtection.PAGE_GUARD) and
+               _in_dump(index, a, s)]
+    regions.sort()
+    starts = [a for (a, _) in regions]
+    stack_regions = set()
+    for (a, _) in stacks:
+        i = bisect_right(starts, a) - 1
+        if i >= 0 and a < regions[i][0] + regions[i][1]:
+            stack_regions.add(regions[i])
+    heaps = list()
+    pdata = list()
+    for r in regions:
+        if r in stack_regions:
+            continue
+        o = index.offset(r[0])
+        if (r[1] >= 12 and
+                _WORD_.unpack_from(reader.data, o + 8)[0] == _HEAP_SIGNATURE_):
+            heaps.append(r)
         else:
-            raise ValueError(
-                'No corresponding offset for address: {:#08x}'.format(address))
+            pdata.append(r)
+    return heaps, sorted(stack_regions), pdata
+
+
+def _in_dump(index, address, size):
+    '''
+    Return True if the "size" bytes at "address" are contiguous in
+    the memory dump.
+    '''
+    try:
+        return index.offset(address + size) - index.offset(address) == size
+    except ValueError:
+        return False
 
 
-def _read_memory_dump_data(dumpfile):
+def _translate(values, starts, targets, sizes, error):
+    '''
+    Translates an array of values between two spaces given the
+    sorted starts of the segments in the first space, their
+    starts in the second one and their sizes.
+    '''
+    i = np.searchsorted(starts, values, side='right') - 1
+    if len(starts):
+        bad = (i < 0) | (values > starts[i] + sizes[i])
+    else:
+        bad = np.ones(len(values), dtype=bool)
+    if bad.any():
+        raise ValueError(error.format(int(values[bad][0])))
+    return targets[i] + values - starts[i]
+
+
+def _read_memory_dump_data(dumpfile, mmapped=False):
     with open(dumpfile, 'rb') as f:
+        if mmapped:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         return f.read()
 
+
+def _data_view(data, offset, size):
+    '''
+    Return a zero-copy view of "size" bytes of "data" starting
+    at "offset".
+    '''
+    return buffer(data, offset, size)
+
 # TODO: does NOT requires txt
 # def _read_metadata(mdtype, dumpfile):
 #     '''
@@ -210,40 +513,40 @@ def _read_metadata(mdtype, dumpfile):
         segments = list()
         for line in f:
             if mdtype == _SegmentType.Module:
-                segments.append((int(line.split(':')[0], 16),
-                                 int(line.split(':')[1], 16),
-                                 line.split(':')[2].rstrip()))
-            elif mdtype == _SegmentType.Heap:
-                segments.append((int(line.split()[0], 16),
-                                 int(line.split()[5].replace(',', '')) * 1024))
-            elif mdtype == _SegmentType.Pdata:
-                segments.append((int(line.split()[0], 16),
-                                 int(line.split()[4].replace(',', '')) * 1024))
-            elif mdtype == _SegmentType.Stack:
-                segments.append((int(line.split()[0], 16),
-                                 int(line.split()[4].replace(',', '')) * 1024))
-            else:  # mdtype == _SegmentType.Segment
-                segments.append((int(line.split(':')[0], 16),
-                                 int(line.split(':')[1], 16)))
+                fields = line.rstrip().split(':')
+                segments.append((int(fields[0], 16), int(fields[1], 16),
+                                 fields[2]))
+                continue
+            if mdtype == _SegmentType.Segment:
+                fields = line.split(':')
+                segments.append((int(fields[0], 16), int(fields[1], 16)))
+                continue
+            fields = line.split()
+            if mdtype == _SegmentType.Heap:
+                size = fields[5]
+            else:  # mdtype in (_SegmentType.Pdata, _SegmentType.Stack)
+                size = fields[4]
+            segments.append((int(fields[0], 16),
+                             int(size.replace(',', '')) * 1024))
     return segments
 
 
-_afo = _address_from_offset
-_ofa = _offset_from_address
-
-
 def _process_cmd_line(argv):
     '''Memory dump analysis.
 
 Usage:
-    memorydump.py [-v] <dump>
-    memorydump.py convert [-v] <dump> (-a <address> | -o <offset>)
-    memorydump.py extract [-v] <dump> -a <address>
+    memorydump.py [-v] [-m] <dump>
+    memorydump.py convert [-v] [-m] <dump> (-a <address> | -o <offset>)
+    memorydump.py extract [-v] [-m] <dump> -a <address>
+    memorydump.py index [-v] <dumps>...
     memorydump.py (-h | --version)
 
 Options:
+    <dumps>       Memory dumps whose text metadata files are written
+                  to a binary .meta file.
     -a <address>  Virtual address to convert.
     -o <offset>   Offset to convert.
+    -m --mmap     Memory-maps the .core or .dmp file instead of reading it.
     -h --help     Shows this message.
     -v --verbose  Shows details.
     --version     Shows the current version.
@@ -269,16 +572,23 @@ Options:
     if args['--verbose']:
         print(args)
     return (args['<dump>'], args['-a'], args['-o'], args['convert'],
-            args['extract'], args['--verbose'])
+            args['extract'], args['index'], args['<dumps>'], args['--mmap'],
+            args['--verbose'])
 
 
 def main(argv=None):
-    (dumpfile, address, offset, convert, extract,
+    (dumpfile, address, offset, convert, extract, index, dumpfiles, mmapped,
      verbose) = _process_cmd_line(argv)
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    dump = load_memory_dump(dumpfile)
+    if index:
+        for d in dumpfiles:
+            write_binary_metadata(d + _METADATA_EXT_, read_text_metadata(d))
+            print('{}{} written'.format(d, _METADATA_EXT_))
+        return 0
+
+    dump = load_memory_dump(dumpfile, mmapped)
 
     if convert:
         try:
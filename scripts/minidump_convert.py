@@ -5,39 +5,24 @@ Created on Nov 26, 2012
 @author: David I. Urbina
 """
 from __future__ import print_function
+from contextlib import contextmanager
+import glob
 import logging
+import multiprocessing as mp
+import os
+import struct
 import sys
+import time
 
 from docopt import docopt
 
-from minidump import *
+from minidump_reader import MinidumpReader, StreamType, is_stdlib_module
 
 
 # Constants
 __version__ = 1.0
-
-# Modules to exclude
-# _STDLIB_EXC_ = []
-_STDLIB_EXC_ = ['rpcrt4.dll', 'ole32.dll', 'advapi32.dll', 'user32.dll',
-                'comctl32.dll', 'winmm.dll', 'secur32.dll', 'gdi32.dll',
-                'gdiplus.dll', 'wininet.dll', 'crypt32.dll', 'msasn1.dll',
-                'oleaut32.dll', 'shlwapi.dll', 'comdlg32.dll', 'shell32.dll',
-                'winspool.drv', 'oledlg.dll', 'version.dll', 'riched32.dll',
-                'riched20.dll', 'rsaenh.dll', 'clbcatq.dll', 'comres.dll',
-                'shdocvw.dll', 'cryptui.dll', 'netapi32.dll', 'wintrust.dll',
-                'imagehlp.dll', 'wldap32.dll', 'uxtheme.dll', 'xpsp2res.dll',
-                'wtsapi32.dll', 'winsta.dll', 'imm32.dll', 'msimg32.dll',
-                'apphelp.dll', 'ws2_32.dll', 'ws2help.dll', 'urlmon.dll',
-                'setupapi.dll', 'msacm32.dll', 'sensapi.dll', 'oleacc.dll',
-                'iphlpapi.dll', 'wsock32.dll', 'msls31.dl', 'psapi.dll',
-                'sxs.dll', 'mlang.dll', 'simtf.dll', 'rasapi32.dll',
-                'rasman.dll', 'tapi32.dll', 'rtutils.dll', 'shdoclc.dll',
-                'jscript.dll', 'mswsock.dll', 'hnetcfg.dll', 'wshtcpip.dll',
-                'dnsapi.dll', 'winrnr.dll', 'rasadhlp.dll', 'schannel.dll',
-                'userenv.dll', 'dssenh.dll', 'perfos.dll', 'wdmaud.drv',
-                'msacm32.drv', 'midimap.dll', 'msvcr100.dll', 'msvcp100.dll',
-                'kernel32.dll', 'msvcrt.dll', 'ntdll.dll', 'mshtml.dll',
-                'msctf.dll']
+_COPY_BUFFER_SZ_ = 1 << 24
+_MINIDUMP_EXT_ = '.dmp'
 
 # Modules to include
 _STDLIB_INCL_ = ['kernel32.dll', 'msvcrt.dll', 'ntdll.dll', 'mshtml.dll',
@@ -45,84 +30,234 @@ _STDLIB_INCL_ = ['kernel32.dll', 'msvcrt.dll', 'ntdll.dll', 'mshtml.dll',
 
 
 def extract_core(filename, minidump):
-    with open(filename, 'rb') as f:
-        for s in minidump.MINIDUMP_DIRECTORY:
-            if s.StreamType == 'Memory64ListStream':
-                logging.debug('Extracting core...')
-                with open(filename.replace('dmp', 'core'), 'w') as f2:
-                    f2.write(f.read()[s.DirectoryData.BaseRva:])
-                logging.info('Core extracted')
-                return
+    if StreamType.Memory64ListStream in minidump.streams:
+        logging.debug('Extracting core...')
+        base_rva, descriptors = minidump.memory64_list()
+        size = int(descriptors['size'].sum())
+        with open(filename, 'rb') as src:
+            with _output(filename, '.core', 'wb') as dst:
+                if _copy_range(src, dst, base_rva, size) != size:
+                    raise IOError('Truncated core in {}'.format(filename))
+        logging.info('Core extracted')
 
 
 def extract_segments(filename, minidump):
-    for s in minidump.MINIDUMP_DIRECTORY:
-        if s.StreamType == 'Memory64ListStream':
-            logging.debug('Extracting segments...')
-            with open(filename.replace('dmp', 'segments'), 'w') as f:
-                for d in s.DirectoryData.MINIDUMP_MEMORY_DESCRIPTOR64:
-                    value = '{:x}:{:x}\n'.format(d.StartOfMemoryRange,
-                                                 d.DataSize)
-                    f.write(value)
-            logging.info('Segments extracted')
-            return
+    if StreamType.Memory64ListStream in minidump.streams:
+        logging.debug('Extracting segments...')
+        _, descriptors = minidump.memory64_list()
+        with _output(filename, '.segments', 'w') as f:
+            for (start, size) in descriptors.tolist():
+                f.write('{:x}:{:x}\n'.format(start, size))
+        logging.info('Segments extracted')
 
 
 def extract_modules(filename, minidump, all_mod):
-    for s in minidump.MINIDUMP_DIRECTORY:
-        if s.StreamType == 'ModuleListStream':
-            logging.debug('Extracting modules...')
-            with open(filename.replace('dmp', 'modules'), 'w') as f:
-                for m in s.DirectoryData.MINIDUMP_MODULE:
-                    if not all_mod and any(x in m.ModuleName.lower()
-                                           for x in _STDLIB_EXC_):
-                        continue
-                    name = m.ModuleName.split('\\')[-1]
-                    value = '{:x}:{:x}:{}\n'.format(m.BaseOfImage,
-                                                    m.SizeOfImage, name)
-                    f.write(value)
-            logging.info('Modules extracted')
-            return
+    if StreamType.ModuleListStream in minidump.streams:
+        logging.debug('Extracting modules...')
+        with _output(filename, '.modules', 'w') as f:
+            for (base, size, path) in minidump.modules():
+                if not all_mod and is_stdlib_module(path):
+                    continue
+                name = path.split('\\')[-1]
+                value = '{:x}:{:x}:{}\n'.format(base, size, name)
+                f.write(value)
+        logging.info('Modules extracted')
+
+
+def convert_minidump(filename, mod=False, allmod=False, seg=False,
+                     core=False, force=False):
+    '''
+    Extracts the requested files of a minidump. Returns the size of
+    the minidump and the seconds taken, or None if the files were
+    newer than the minidump and "force" is False.
+    '''
+    if not force and _up_to_date(filename, _outputs(mod or allmod, seg,
+                                                    core)):
+        logging.debug('{} is up to date'.format(filename))
+        return None
+    start = time.time()
+    with MinidumpReader(filename) as minidump:
+        if core:
+            extract_core(filename, minidump)
+        if seg:
+            extract_segments(filename, minidump)
+        if mod or allmod:
+            extract_modules(filename, minidump, allmod)
+        size = len(minidump.data)
+    return size, time.time() - start
+
+
+def convert_minidumps(filenames, jobs=1, **options):
+    '''
+    Converts the minidumps and yields each file name with the result
+    of convert_minidump and the error that stopped its conversion, if
+    any, in completion order when more than one job is used. An error
+    in one minidump does not stop the others.
+    '''
+    if jobs <= 1:
+        for f in filenames:
+            yield _convert_minidump((f, options))
+        return
+    pool = mp.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(
+                _convert_minidump, [(f, options) for f in filenames]):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def find_minidumps(paths):
+    '''
+    Returns the minidumps in "paths", which can be files, glob
+    patterns or directories searched recursively.
+    '''
+    minidumps = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, _, filenames) in os.walk(path):
+                minidumps.extend(os.path.join(dirpath, f)
+                                 for f in sorted(filenames)
+                                 if f.endswith(_MINIDUMP_EXT_))
+        else:
+            minidumps.extend(sorted(glob.glob(path)) or [path])
+    return minidumps
+
+
+def _convert_minidump(args):
+    filename, options = args
+    try:
+        return filename, convert_minidump(filename, **options), None
+    except (IOError, OSError, ValueError, struct.error) as e:
+        return filename, None, str(e)
+
+
+def _output_name(filename, ext):
+    if filename.endswith(_MINIDUMP_EXT_):
+        filename = filename[:-len(_MINIDUMP_EXT_)]
+    return filename + ext
+
+
+@contextmanager
+def _output(filename, ext, mode):
+    '''
+    Opens a temporary output file that replaces the "ext" file of the
+    minidump only once it is completely written.
+    '''
+    output = _output_name(filename, ext)
+    temp = '{}.{}.tmp'.format(output, os.getpid())
+    try:
+        with open(temp, mode) as f:
+            yield f
+        os.rename(temp, output)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def _outputs(mod, seg, core):
+    return ([e for (e, x) in (('.core', core), ('.segments', seg),
+                              ('.modules', mod)) if x])
+
+
+def _up_to_date(filename, outputs):
+    '''
+    Returns True if every output file of the minidump exists and is
+    not older than it.
+    '''
+    mtime = os.path.getmtime(filename)
+    for ext in outputs:
+        output = _output_name(filename, ext)
+        if not os.path.exists(output) or os.path.getmtime(output) < mtime:
+            return False
+    return True
+
+
+def _copy_range(src, dst, offset, size):
+    '''
+    Copies size bytes of src from offset to dst in constant memory,
+    kernel-side when os.sendfile is available.
+    '''
+    src.seek(offset)
+    copied = 0
+    while copied < size:
+        n = min(_COPY_BUFFER_SZ_, size - copied)
+        if hasattr(os, 'sendfile'):
+            n = os.sendfile(dst.fileno(), src.fileno(), offset + copied, n)
+        else:
+            data = src.read(n)
+            n = len(data)
+            dst.write(data)
+        if not n:
+            break
+        copied += n
+        logging.debug('{}/{} bytes copied'.format(copied, size))
+    return copied
 
 
 def _process_cmd_line(argv):
     '''Minidump converter.
 
 Usage:
-    minidump_convert.py [options] <dump>
+    minidump_convert.py [options] <dump>...
     minidump_convert.py (-h | --help | --version)
 
 Options:
-    <dump>        The minidump file.
-    -m            Extract non-standard modules.
-    -M            Extract all modules.
-    -s            Extract segments.
-    -c            Extract core.
-    -v --verbose  Verbose.
-    -h --help     Shows this help.
-    --version     Shows the current version.
+    <dump>         The minidump files, glob patterns or directories.
+    -m             Extract non-standard modules.
+    -M             Extract all modules.
+    -s             Extract segments.
+    -c             Extract core.
+    -f --force     Convert minidumps whose files are up to date.
+    -j --jobs <n>  Number of worker processes [default: 1].
+    -v --verbose   Verbose.
+    -h --help      Shows this help.
+    --version      Shows the current version.
     '''
     # initializing the parser object
     args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
 
+    # checking arguments
+    try:
+        args['--jobs'] = int(args['--jobs'])
+    except ValueError:
+        print('Error: Invalid number of jobs', args['--jobs'],
+              file=sys.stderr)
+        sys.exit(1)
+
     return (args['<dump>'], args['-m'], args['-M'], args['-s'],
-            args['-c'], args['--verbose'])
+            args['-c'], args['--force'], args['--jobs'], args['--verbose'])
 
 
 def main(argv=None):
-    dumpfile, mod, allmod, seg, core, verbose = _process_cmd_line(argv)
+    (paths, mod, allmod, seg, core, force, jobs,
+     verbose) = _process_cmd_line(argv)
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    minidump = MINIDUMP_HEADER.parse_stream(open(dumpfile))
-
-    if core:
-        extract_core(dumpfile, minidump)
-    if seg:
-        extract_segments(dumpfile, minidump)
-    if mod or allmod:
-        extract_modules(dumpfile, minidump, allmod)
-    return 0
+    total_size = 0
+    errors = 0
+    start = time.time()
+    for (dumpfile, result, error) in convert_minidumps(
+            find_minidumps(paths), jobs, mod=mod, allmod=allmod, seg=seg,
+            core=core, force=force):
+        if error:
+            print('Error: {}: {}'.format(dumpfile, error), file=sys.stderr)
+            errors += 1
+            continue
+        if result is None:
+            print('{}: up to date'.format(dumpfile))
+            continue
+        size, seconds = result
+        total_size += size
+        print('{}: {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+            dumpfile, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-6)))
+    seconds = time.time() - start
+    print('Total: {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+        total_size / 1e6, seconds, total_size / 1e6 / max(seconds, 1e-6)))
+    return 1 if errors else 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Lazy reader of the streams of a minidump.
+"""
+
+# imports
+from __future__ import print_function
+import logging
+import mmap
+import struct
+import sys
+
+from docopt import docopt
+import numpy as np
+
+
+# constants
+
+__version__ = 1.0
+# Signature, Version, ImplementationVersion, NumberOfStreams,
+# StreamDirectoryRva, CheckSum, TimeDateStamp, Flags
+_HEADER_ = struct.Struct('<4sHHIIIIQ')
+# StreamType, DataSize, Rva
+_DIRECTORY_ENTRY_ = struct.Struct('<III')
+_SIGNATURE_ = 'MDMP'
+_COUNT32_ = struct.Struct('<I')
+# NumberOfMemoryRanges, BaseRva
+_MEMORY64_LIST_ = struct.Struct('<QQ')
+# SizeOfHeader, SizeOfEntry, NumberOfEntries
+_MEMORY_INFO_LIST_ = struct.Struct('<IIQ')
+_MEMORY_DESCRIPTOR64_ = np.dtype([('start', '<u8'), ('size', '<u8')])
+_MODULE_ = np.dtype({'names': ['base', 'size', 'name_rva'],
+                     'formats': ['<u8', '<u4', '<u4'],
+                     'offsets': [0, 8, 20], 'itemsize': 108})
+_THREAD_ = np.dtype({'names': ['thread_id', 'teb', 'stack_start',
+                               'stack_size', 'stack_rva', 'context_size',
+                               'context_rva'],
+                     'formats': ['<u4', '<u8', '<u8', '<u4', '<u4', '<u4',
+                                 '<u4'],
+                     'offsets': [0, 16, 24, 32, 36, 40, 44],
+                     'itemsize': 48})
+_MEMORY_INFO_FIELDS_ = {'names': ['base', 'allocation_base',
+                                  'allocation_protect', 'region_size',
+                                  'state', 'protect', 'type'],
+                        'formats': ['<u8', '<u8', '<u4', '<u8', '<u4',
+                                    '<u4', '<u4'],
+                        'offsets': [0, 8, 16, 24, 32, 36, 40]}
+# Standard modules, left out of the memory dumps unless all modules are
+# requested
+STDLIB_MODULES = ['rpcrt4.dll', 'ole32.dll', 'advapi32.dll', 'user32.dll',
+                  'comctl32.dll', 'winmm.dll', 'secur32.dll', 'gdi32.dll',
+                  'gdiplus.dll', 'wininet.dll', 'crypt32.dll', 'msasn1.dll',
+                  'oleaut32.dll', 'shlwapi.dll', 'comdlg32.dll', 'shell32.dll',
+                  'winspool.drv', 'oledlg.dll', 'version.dll', 'riched32.dll',
+                  'riched20.dll', 'rsaenh.dll', 'clbcatq.dll', 'comres.dll',
+                  'shdocvw.dll', 'cryptui.dll', 'netapi32.dll', 'wintrust.dll',
+                  'imagehlp.dll', 'wldap32.dll', 'uxtheme.dll', 'xpsp2res.dll',
+                  'wtsapi32.dll', 'winsta.dll', 'imm32.dll', 'msimg32.dll',
+                  'apphelp.dll', 'ws2_32.dll', 'ws2help.dll', 'urlmon.dll',
+                  'setupapi.dll', 'msacm32.dll', 'sensapi.dll', 'oleacc.dll',
+                  'iphlpapi.dll', 'wsock32.dll', 'msls31.dl', 'psapi.dll',
+                  'sxs.dll', 'mlang.dll', 'simtf.dll', 'rasapi32.dll',
+                  'rasman.dll', 'tapi32.dll', 'rtutils.dll', 'shdoclc.dll',
+                  'jscript.dll', 'mswsock.dll', 'hnetcfg.dll', 'wshtcpip.dll',
+                  'dnsapi.dll', 'winrnr.dll', 'rasadhlp.dll', 'schannel.dll',
+                  'userenv.dll', 'dssenh.dll', 'perfos.dll', 'wdmaud.drv',
+                  'msacm32.drv', 'midimap.dll', 'msvcr100.dll', 'msvcp100.dll',
+                  'kernel32.dll', 'msvcrt.dll', 'ntdll.dll', 'mshtml.dll',
+                  'msctf.dll']
+
+
+# exception classes
+
+
+# interface classes
+
+class StreamType:
+    ThreadListStream = 3
+    ModuleListStream = 4
+    MemoryListStream = 5
+    Memory64ListStream = 9
+    MemoryInfoListStream = 16
+
+
+class MemoryState:
+    MEM_COMMIT = 0x1000
+    MEM_RESERVE = 0x2000
+    MEM_FREE = 0x10000
+
+
+class MemoryType:
+    MEM_IMAGE = 0x1000000
+    MEM_MAPPED = 0x40000
+    MEM_PRIVATE = 0x20000
+
+
+class MemoryProtection:
+    PAGE_NOACCESS = 0x01
+    PAGE_GUARD = 0x100
+
+
+class MinidumpReader(object):
+    '''
+    Lazy minidump reader. Opening a minidump decodes only its header
+    and stream directory; each stream is decoded when it is first
+    requested, straight from the memory-mapped file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < _HEADER_.size:
+            raise ValueError('Truncated minidump: {}'.format(filename))
+        (signature, self.version, _, count, rva, _, self.timestamp,
+         self.flags) = _HEADER_.unpack_from(self.data)
+        if signature != _SIGNATURE_:
+            raise ValueError('Not a minidump: {}'.format(filename))
+        self.streams = dict()
+        for i in xrange(count):
+            stream_type, size, srva = _DIRECTORY_ENTRY_.unpack_from(
+                self.data, rva + i * _DIRECTORY_ENTRY_.size)
+            self.streams.setdefault(stream_type, (srva, size))
+        logging.debug('{} streams in {}'.format(count, filename))
+        self._cache = dict()
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def memory64_list(self):
+        '''
+        Returns the base RVA of the memory ranges and an array of
+        their (start, size) descriptors, in file order.
+        '''
+        if 'memory64' not in self._cache:
+            rva = self._stream(StreamType.Memory64ListStream)
+            count, base_rva = _MEMORY64_LIST_.unpack_from(self.data, rva)
+            self._cache['memory64'] = (base_rva, self._array(
+                _MEMORY_DESCRIPTOR64_, rva + _MEMORY64_LIST_.size, count))
+        return self._cache['memory64']
+
+    def memory_ranges(self):
+        '''
+        Returns the start addresses, sizes and file offsets of the
+        memory ranges as arrays.
+        '''
+        base_rva, descriptors = self.memory64_list()
+        sizes = descriptors['size'].astype(np.int64)
+        return (descriptors['start'].astype(np.int64), sizes,
+                base_rva + np.cumsum(sizes) - sizes)
+
+    def modules(self):
+        '''
+        Returns the list of (base, size, path) of the loaded modules.
+        '''
+        if 'modules' not in self._cache:
+            rva = self._stream(StreamType.ModuleListStream)
+            count = _COUNT32_.unpack_from(self.data, rva)[0]
+            table = self._array(_MODULE_, rva + _COUNT32_.size, count)
+            self._cache['modules'] = [
+                (base, size, self.string(name_rva)) for (base, size, name_rva)
+                in zip(table['base'].tolist(), table['size'].tolist(),
+                       table['name_rva'].tolist())]
+        return self._cache['modules']
+
+    def threads(self):
+        '''
+        Returns the array of thread records with their stack
+        descriptors.
+        '''
+        if 'threads' not in self._cache:
+            rva = self._stream(StreamType.ThreadListStream)
+            count = _COUNT32_.unpack_from(self.data, rva)[0]
+            self._cache['threads'] = self._array(_THREAD_,
+                                                 rva + _COUNT32_.size, count)
+        return self._cache['threads']
+
+    def memory_info(self):
+        '''
+        Returns the array of memory region records of the address
+        space.
+        '''
+        if 'memory_info' not in self._cache:
+            rva = self._stream(StreamType.MemoryInfoListStream)
+            header, entry, count = _MEMORY_INFO_LIST_.unpack_from(self.data,
+                                                                  rva)
+            dtype = np.dtype(dict(_MEMORY_INFO_FIELDS_, itemsize=entry))
+            self._cache['memory_info'] = self._array(dtype, rva + header,
+                                                     count)
+        return self._cache['memory_info']
+
+    def string(self, rva):
+        '''
+        Returns the MINIDUMP_STRING at rva.
+        '''
+        length = _COUNT32_.unpack_from(self.data, rva)[0]
+        start = rva + _COUNT32_.size
+        return self.data[start:start + length].decode('utf-16-le')
+
+    def _stream(self, stream_type):
+        if stream_type not in self.streams:
+            raise ValueError('No stream {} in {}'.format(stream_type,
+                                                         self.filename))
+        return self.streams[stream_type][0]
+
+    def _array(self, dtype, offset, count):
+        if offset + count * dtype.itemsize > len(self.data):
+            raise ValueError('Truncated stream in {}'.format(self.filename))
+        return np.frombuffer(self.data, dtype=dtype, count=count,
+                             offset=offset)
+
+
+# interface functions
+
+def is_stdlib_module(path):
+    '''
+    Returns True if the module at "path" is one of the standard
+    modules.
+    '''
+    path = path.lower()
+    return any(x in path for x in STDLIB_MODULES)
+
+
+# internal functions
+
+def _process_cmd_line(argv):
+    '''Lazy minidump reader.
+
+Usage:
+    minidump_reader.py <minidump>
+    minidump_reader.py (-h | --help | --version)
+
+Options:
+    <minidump>  The minidump file.
+    -h --help   Shows this help.
+    --version   Shows the current version.
+    '''
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    return args['<minidump>']
+
+
+def main(argv=None):
+    minidumpfile = _process_cmd_line(argv)
+    with MinidumpReader(minidumpfile) as reader:
+        print('Streams: {}'.format(sorted(reader.streams)))
+        if StreamType.Memory64ListStream in reader.streams:
+            starts, sizes, _ = reader.memory_ranges()
+            print('Memory ranges: {} ({} bytes)'.format(len(starts),
+                                                        sizes.sum()))
+        if StreamType.ModuleListStream in reader.streams:
+            for (base, size, path) in reader.modules():
+                print('{:08x} {:8x} {}'.format(base, size, path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
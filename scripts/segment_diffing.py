@@ -11,7 +11,9 @@ import logging
 import sys
 
 from docopt import docopt
+import numpy as np
 
+from segments import Stack
 import graph_generator
 import memorydump
 
@@ -19,6 +21,7 @@ import memorydump
 # constants
 
 __version__ = 1.0
+_CHUNK_SZ_ = 1 << 22
 
 # exception classes
 # interface classes
@@ -27,28 +30,100 @@ __version__ = 1.0
 # interface functions
 
 def diff_segments(*seg):
-    sets = list()
+    """Returns the offsets at which every consecutive pair of segments
+    differs, as (start, end) ranges with end excluded. Stacks are
+    compared from their top, at offsets starting at 1.
+    """
+    changed = None
     for i in xrange(len(seg) - 1):
-        sets.append(set(_diff_pair_memory_segments(seg[i], seg[i + 1])))
-    return set.intersection(*sets)
+        mask = _diff_pair_memory_segments(seg[i], seg[i + 1])
+        if changed is None:
+            changed = mask
+        else:
+            n = min(len(changed), len(mask))
+            changed = changed[:n] & mask[:n]
+    if changed is None:
+        return list()
+    return _changed_ranges(changed, 1 if isinstance(seg[0], Stack) else 0)
+
+
+def diff_memory_dumps(dumps, chunk_size=_CHUNK_SZ_):
+    """Yields the address ranges, end excluded, at which every
+    consecutive pair of memory dumps differs. Segments are aligned
+    by address and the ones missing from any dump are skipped. Each
+    segment is compared chunk_size bytes at a time, so memory-mapped
+    dumps are never read whole.
+    """
+    if len(dumps) < 2:
+        return
+    segments = [dict((s.address, s) for s in d.segments) for d in dumps]
+    addresses = set.intersection(*[set(s) for s in segments])
+    logging.debug('{} segments in every dump'.format(len(addresses)))
+    for address in sorted(addresses):
+        seg = [s[address] for s in segments]
+        size = max(s.size for s in seg)
+        pending = None
+        for start in xrange(0, size, chunk_size):
+            changed = _diff_chunk(seg, start, min(start + chunk_size, size))
+            for (first, last) in _changed_ranges(changed, address + start):
+                if pending and pending[1] == first:
+                    pending = (pending[0], last)
+                    continue
+                if pending:
+                    yield pending
+                pending = (first, last)
+        if pending:
+            yield pending
 
 # internal classes
 
 
 # internal functions
 
-def _diff_pair_memory_segments(segment1, segment2):
-    offsets = list()
-    for s1, s2 in zip(segment1.walk_by_byte(), segment2.walk_by_byte()):
-        if s1[0] != s2[0]:
-            offsets.append(s1[1])
-    if segment1.size > segment2.size:
-        l, s = segment1, segment2
-    else:  # if segment2.size > segment1.size:
-        l, s = segment2, segment1
-    for i in xrange(l.size, s.size - 1):
-        offsets.append(i)
-    return offsets
+def _diff_pair_memory_segments(segment1, segment2, start=0, end=None):
+    """Returns a mask of the bytes that differ between two segments,
+    in walk_by_byte order, from position start to end. The bytes past
+    the end of the shorter segment count as changed.
+    """
+    bytes1 = _segment_bytes(segment1, start, end)
+    bytes2 = _segment_bytes(segment2, start, end)
+    n = min(len(bytes1), len(bytes2))
+    mask = np.ones(max(len(bytes1), len(bytes2)), dtype=bool)
+    mask[:n] = bytes1[:n] != bytes2[:n]
+    return mask
+
+
+def _diff_chunk(segments, start, end):
+    """Returns a mask of the bytes from start to end that differ in
+    every consecutive pair of segments.
+    """
+    changed = np.ones(end - start, dtype=bool)
+    for i in xrange(len(segments) - 1):
+        mask = _diff_pair_memory_segments(segments[i], segments[i + 1],
+                                          start, end)
+        changed[len(mask):] = False
+        changed[:len(mask)] &= mask
+    return changed
+
+
+def _segment_bytes(segment, start=0, end=None):
+    end = segment.size if end is None else min(end, segment.size)
+    if end <= start:
+        return np.empty(0, dtype=np.uint8)
+    if isinstance(segment, Stack):
+        return np.frombuffer(segment.data, dtype=np.uint8, count=end - start,
+                             offset=segment.size - end)[::-1]
+    return np.frombuffer(segment.data, dtype=np.uint8, count=end - start,
+                         offset=start)
+
+
+def _changed_ranges(mask, origin=0):
+    """Returns the runs of True values of mask as (start, end) ranges.
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask,
+                                                   [False])).view(np.int8)))
+    return [(int(start) + origin, int(end) + origin)
+            for (start, end) in zip(edges[::2], edges[1::2])]
 
 
 def _process_cmd_line(argv):
@@ -90,7 +165,7 @@ def main(argv=None):
         logging.basicConfig(level=logging.DEBUG)
 
     logging.debug('Loading positive memory dumps...')
-    dumps = map(memorydump.load_memory_dump, dumpfiles)
+    dumps = [memorydump.load_memory_dump(d, full) for d in dumpfiles]
 
     if not full:
         graphs = map(graph_generator.generate_graph, dumps)
@@ -98,8 +173,9 @@ def main(argv=None):
                    [address] * len(graphs))
         diffing = diff_segments(*segs)
     else:
-        pass
-    print(diffing)
+        diffing = diff_memory_dumps(dumps)
+    for (start, end) in diffing:
+        print('{:#x}-{:#x}'.format(start, end))
 
     return 0
 
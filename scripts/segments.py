@@ -6,9 +6,13 @@ Created on May 2, 2013
 """
 
 # imports
+import copy
+import hashlib
 import math
 import struct
 import logging
+
+import numpy as np
 # constants
 _WORD_SIZE = 4
 # exception classes
@@ -26,6 +30,7 @@ class Segment(object):
         self.data = [] if data is None else data
         self.type = type(self).__name__
         self.hash = None
+        self._digest = None
 
     def __repr__(self):
         if self.offset or self.offset == 0:
@@ -39,14 +44,31 @@ class Segment(object):
         return '{:#08x}({})'.format(self.address, self.size)
 
     def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+        if not isinstance(other, Segment):
+            return False
+        return (self.address == other.address and self.size == other.size
+                and self.digest == other.digest)
 
     def __hash__(self):
         if self.hash == None:
-            self.hash = hash(repr(self.address) + repr(self.size) +
-                             repr(self.data))
+            self.hash = hash((self.address, self.size, self.digest))
         return self.hash
 
+    @property
+    def digest(self):
+        '''MD5 digest of the data, computed once over the buffer.
+        '''
+        if self._digest is None:
+            self._digest = hashlib.md5(self.data if len(self.data)
+                                       else '').digest()
+        return self._digest
+
+    def __deepcopy__(self, memo):
+        # the data is a read-only view shared with the memory dump
+        result = copy.copy(self)
+        memo[id(self)] = result
+        return result
+
     def walk_by_word(self):
     #         logging.debug('Walking {}'.format(self.__class__))
         from_ = 0
@@ -55,6 +77,16 @@ class Segment(object):
         for i in xrange(from_, to_, step):
             yield struct.unpack('<I', self.data[i:i + _WORD_SIZE])[0], i
 
+    def words(self):
+        '''Returns the little-endian words of the segment and their
+        offsets as arrays, in the same order as walk_by_word.
+        '''
+        count = self.size / _WORD_SIZE
+        if count < 1:
+            return _empty_words()
+        return (np.frombuffer(self.data, dtype='<u4', count=count),
+                np.arange(0, count * _WORD_SIZE, _WORD_SIZE))
+
     def walk_by_byte(self):
         for i in xrange(self.size - 1):
             yield self.data[i], i
@@ -91,6 +123,16 @@ class Stack(Segment):
             yield (struct.unpack('<I', self.data[i:i + _WORD_SIZE])[0],
                    self.size - i)
 
+    def words(self):
+        start = self.size % _WORD_SIZE
+        count = self.size / _WORD_SIZE
+        if count < 2:
+            return _empty_words()
+        values = np.frombuffer(self.data, dtype='<u4', count=count,
+                               offset=start)
+        positions = start + _WORD_SIZE * np.arange(count - 1, 0, -1)
+        return values[:0:-1], self.size - positions
+
     def walk_by_byte(self):
         for i in xrange(self.size - 1, 0, -1):
             yield self.data[i], self.size - i
@@ -101,4 +143,8 @@ class PrivateData(Segment):
         super(PrivateData, self).__init__(address, size, offset, data)
 
 # internal functions
+
+def _empty_words():
+    return np.empty(0, dtype='<u4'), np.empty(0, dtype=np.int64)
+
 # internal classes
@@ -6,41 +6,202 @@ Created on May 2, 2013
 """
 
 # imports
+from __future__ import print_function
+from collections import deque
 import argparse
+import logging
 import sys
+
+from segments import Module
+import graph_diffing
 # constants
 # exception classes
 # interface functions
 
 
+def generate_signatures(graph, targets, graphs):
+    """Returns the signature paths from the root nodes of a memory
+    graph to the targets as (score, root, labels) tuples, most stable
+    first. The score is the fraction of graphs in which the path
+    resolves.
+    """
+    trie = signature_paths(graph, targets)
+    scores = score_signatures(trie, graphs)
+    return sorted(((scores[p], p[0], p[1]) for p in trie),
+                  key=lambda s: (-s[0], len(s[2]), s[1], s[2]))
+
+
+def signature_paths(graph, targets):
+    """Returns a SignatureTrie with the canonical pointer path from
+    each root node to each target it reaches. The canonical path is
+    the shortest one with the smallest (offset_src, offset_dest)
+    labels, found with one breadth-first traversal per root over the
+    nodes on paths to the targets.
+    """
+    targets = set(t for t in targets if t in graph)
+    nodes = graph_diffing.on_path_nodes(graph, graph.root_nodes, targets)
+    trie = SignatureTrie()
+    for root in sorted((r for r in graph.root_nodes if r in nodes),
+                       key=lambda r: r.address):
+        parents = {root: None}
+        queue = deque([root])
+        while queue:
+            n = queue.popleft()
+            if n in targets:
+                trie.insert(_root_label(root), _path_labels(parents, n))
+            for (m, label) in sorted(((m, _label(d)) for (m, d)
+                                      in graph.succ[n].iteritems()
+                                      if m in nodes and m not in parents),
+                                     key=lambda e: e[1]):
+                parents[m] = (n, label)
+                queue.append(m)
+    logging.debug('{} signature paths found'.format(len(trie)))
+    return trie
+
+
+def score_signatures(trie, graphs):
+    """Returns a dictionary from each path of a SignatureTrie to the
+    fraction of graphs in which it resolves. graphs can be any
+    iterable; each graph is walked once along the trie.
+    """
+    counts = dict.fromkeys(trie, 0)
+    total = 0
+    for graph in graphs:
+        total += 1
+        roots = dict((_root_label(r), r) for r in graph.root_nodes)
+        for (root, node) in trie.roots.iteritems():
+            if root in roots:
+                for labels in _resolve(graph, node, roots[root]):
+                    counts[(root, labels)] += 1
+    return dict((p, c / float(total) if total else 0.0)
+                for (p, c) in counts.iteritems())
+
+
+def format_signature(root, labels):
+    return ' -> '.join([root] + ['{:#x}:{:#x}'.format(*l) for l in labels])
+
+
 def _process_cmd_line(argv):
-    """Returns a n-tuple: (...)
+    """Returns a 3-tuple: (dumps, mmapped, verbose).
     "argv" is a list of arguments, or "None" for "sys.argv[1:]".
     """
     if argv is None:
         argv = sys.argv[1:]
 
     # initializing the parser object
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='Generates the signature '
+                                                 'paths to the changes '
+                                                 'between memory dumps')
     # defining command options
-    # parser.add_argument()
+    parser.add_argument('-p', required=True, nargs='+', dest='dumps',
+                        metavar='dump', help='list of positive memory dumps')
+    parser.add_argument('-m', '--mmap', action='store_true',
+                        help='memory-maps the .core files')
+    parser.add_argument('--verbose', action='store_true',
+                        help='shows details')
 
     # parsing arguments
     args = parser.parse_args(argv)
 
     # checking arguments
-    # if arg...
-    return args
+    if len(args.dumps) < 2:
+        parser.error('At least two memory dumps are needed')
+    return args.dumps, args.mmap, args.verbose
 
 
 def main(argv=None):
-    # args = _process_cmd_line(argv)
-    pass
+    dumpfiles, mmapped, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    diffing, graph = graph_diffing.fold_memory_graphs(
+        graph_diffing.iter_memory_graphs(dumpfiles, mmapped))
+    signatures = generate_signatures(
+        graph, diffing[0] | diffing[2],
+        graph_diffing.iter_memory_graphs(dumpfiles, mmapped))
+    for (score, root, labels) in signatures:
+        print('{:.2f} {}'.format(score, format_signature(root, labels)))
+    return 0
 
 
 # classes
+
+class SignatureTrie(object):
+    """Prefix tree of signature paths. A path is a root label and a
+    tuple of (offset_src, offset_dest) pointer labels; paths sharing
+    a prefix share its trie nodes.
+    """
+
+    def __init__(self):
+        self.roots = dict()
+        self._len = 0
+
+    def insert(self, root, labels):
+        node = self.roots.setdefault(root, _TrieNode())
+        for label in labels:
+            node = node.children.setdefault(label, _TrieNode())
+        if not node.terminal:
+            node.terminal = True
+            self._len += 1
+
+    def __iter__(self):
+        for root in sorted(self.roots):
+            stack = [(self.roots[root], ())]
+            while stack:
+                node, labels = stack.pop()
+                if node.terminal:
+                    yield root, labels
+                for label in sorted(node.children, reverse=True):
+                    stack.append((node.children[label], labels + (label,)))
+
+    def __len__(self):
+        return self._len
+
+
 # internal functions & classes
 
+class _TrieNode(object):
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = dict()
+        self.terminal = False
+
+
+def _root_label(node):
+    return node.name if isinstance(node, Module) else str(node)
+
+
+def _label(edge):
+    pointer = edge['label']
+    return pointer.offset_src, pointer.offset_dest
+
+
+def _path_labels(parents, node):
+    labels = list()
+    while parents[node]:
+        node, label = parents[node]
+        labels.append(label)
+    return tuple(reversed(labels))
+
+
+def _resolve(graph, trie_node, node):
+    """Yields the label tuples of the trie paths that can be
+    followed in graph from node.
+    """
+    stack = [(trie_node, node, ())]
+    while stack:
+        trie_node, node, labels = stack.pop()
+        if trie_node.terminal:
+            yield labels
+        if not trie_node.children:
+            continue
+        successors = dict((_label(d), m)
+                          for (m, d) in graph.succ[node].iteritems())
+        for (label, child) in trie_node.children.iteritems():
+            if label in successors:
+                stack.append((child, successors[label], labels + (label,)))
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -6,9 +6,20 @@ Created on May 2, 2013
 """
 
 # imports
+from __future__ import print_function
+import cPickle as pickle
+import hashlib
+import logging
+import os
 import sys
 
-import docopt
+from docopt import docopt
+
+import graph_cache
+import graph_diffing
+import memorydump
+import signature_generator
+import value_scannning
 
 # constants
 __author__ = 'David I. Urbina'
@@ -17,64 +28,198 @@ __version__ = 2.0
 # interface functions
 
 
-def _process_cmd_line(argv):
-    """
-    usage: sigpath.py [-h] -p dump [dump ...] [-n dump] [-v value [value ...]]
-                  [-t {string,number}]
+def run_pipeline(dumpfiles, neg_filename=None, values=None, vtype=None,
+                 cachedir='.sigpath', mmapped=False, jobs=1):
+    """Chains graph generation, diffing, value scanning and signature
+    generation over the memory dumps, and returns the signatures as
+    (score, root, labels) tuples.
 
-    Generates a list of signature paths to the data of interest
+    The output of each stage is stored in cachedir under the hash of
+    its inputs, so a run resumes after the last stage whose inputs
+    have not changed. The graphs are cached by graph_cache.
+    """
+    values = values or []
+    keys = dict((d, graph_cache.cache_key(d))
+                for d in dumpfiles + ([neg_filename] if neg_filename else []))
+    diff_key = _stage_key('diff', [keys[d] for d in dumpfiles])
+    value_keys = [_stage_key('values', [keys[d], v, vtype])
+                  for (d, v) in zip(dumpfiles, values)]
+    signatures_key = _stage_key('signatures', [diff_key] + value_keys +
+                                [keys.get(neg_filename, '')])
+
+    signatures = _load_stage(cachedir, 'signatures', signatures_key)
+    if signatures is not None:
+        return signatures
+
+    graph = None
+    diff = None
+    if len(dumpfiles) > 1:
+        diff = _load_stage(cachedir, 'diff', diff_key)
+        if diff is None:
+            diffing, graph = graph_diffing.fold_memory_graphs(
+                graph_diffing.iter_memory_graphs(dumpfiles, mmapped, jobs))
+            diff = [_node_keys(d) for d in diffing]
+            _store_stage(cachedir, 'diff', diff_key, diff)
+        logging.info('Changed nodes: {}, removed nodes: {}, added nodes: '
+                     '{}'.format(*map(len, diff)))
+
+    value_nodes = list()
+    for (dumpfile, value, key) in zip(dumpfiles, values, value_keys):
+        nodes = _load_stage(cachedir, 'values', key)
+        if nodes is None:
+            dump = memorydump.load_memory_dump(dumpfile, mmapped)
+            hits = value_scannning.scan_memory_dump(
+                dump, value_scannning.encode_value(value, vtype))
+            nodes = _node_keys(value_scannning.value_nodes(
+                graph_cache.cached_graph(dump), hits))
+            _store_stage(cachedir, 'values', key, nodes)
+        logging.info('{}: {} nodes hold {}'.format(dumpfile, len(nodes),
+                                                   value))
+        value_nodes.append(set(nodes))
+
+    if graph is None:
+        graph = graph_cache.cached_graph(
+            memorydump.load_memory_dump(dumpfiles[-1], mmapped))
+    targets = None
+    if diff is not None:
+        targets = set(diff[0]) | set(diff[2])
+    if value_nodes:
+        if targets is None:
+            targets = set.intersection(*value_nodes)
+        else:
+            targets.intersection_update(*value_nodes)
+    targets = _seek_nodes(graph, targets)
+    if neg_filename:
+        neggraph = graph_cache.cached_graph(
+            memorydump.load_memory_dump(neg_filename, mmapped))
+        targets.difference_update(neggraph.nodes())
+    logging.info('{} target nodes'.format(len(targets)))
+
+    signatures = signature_generator.generate_signatures(
+        graph, targets, graph_diffing.iter_memory_graphs(dumpfiles, mmapped,
+                                                         jobs))
+    _store_stage(cachedir, 'signatures', signatures_key, signatures)
+    return signatures
 
-    optional arguments:
-      -h, --help            show this help message and exit
-      -p dump [dump ...]    list of positive memory dumps
-      -n dump               negative memory dump
 
-    value scanning:
-      -v value [value ...]  memory dumps' corresponding values
-      -t {string,number}    possible encodings
+def _process_cmd_line(argv):
+    """Generates a list of signature paths to the data of interest.
+
+Usage:
+    sigpath.py [options] <dump>... [-n <neg_dump>] [-t <type> (-v <value>)...]
+    sigpath.py (--help | --version)
+
+Options:
+    <dump>            The list of positive memory dumps.
+    -n <neg_dump>     The negative memory dump.
+    -t <type>         The encodings of the values: string or number.
+    -v <value>        The value of the data of interest in each dump.
+    -c --cache <dir>  Directory of the stage cache [default: .sigpath].
+    -m --mmap         Memory-maps the .core files instead of reading them.
+    -j --jobs <n>     Number of worker processes [default: 1].
+    -h --help         Shows this message.
+    --verbose         Shows details.
+    --version         Shows the current version.
     """
-    #    Return a 4-tuple: (positive dumps, negative dump, values, type).
-    #    "argv" is a list of arguments, or "None" for "sys.argv[1:]".
-    #    '''
-    #    if argv is None:
-    #        argv = sys.argv[1:]
-    #
-    #    # initializing the parser object
-    #    parser = argparse.ArgumentParser(description='Generates a list of \
-    #                                    signature paths to the data of interest')
-    #    # defining command options
-    #    parser.add_argument('-p', required=True, nargs='+', dest='pos_dumps',
-    #                        metavar='dump', help='list of positive memory dumps')
-    #    parser.add_argument('-n', dest='neg_dump', metavar='dump',
-    #                                                help='negative memory dump')
-    #    group = parser.add_argument_group('value scanning')
-    #    group.add_argument('-v', nargs='+', dest='values', metavar='value',
-    #                                    help="memory dumps' corresponding values")
-    #    group.add_argument('-t', dest='type', choices=['string', 'number'],
-    #                                                    help='possible encodings')
-    #    # checking arguments
-    #    args = parser.parse_args(argv)
-    #    if args.values and not args.type:
-    #        parser.error('Value scanning requires encoding')
-    #    if args.values and len(args.pos_dumps) != len(args.values):
-    #        parser.error('Different number of memory dumps and values')
-    #    if len(args.pos_dumps) == 1 and not args.values:
-    #        parser.error('Analysis of one memory dump requires a value')
-
-    docopt()
-
-#    return args.pos_dumps, args.neg_dump, args.values, args.type
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    # checking arguments
+    try:
+        args['--jobs'] = int(args['--jobs'])
+    except ValueError:
+        print('Error: Invalid number of jobs', args['--jobs'],
+              file=sys.stderr)
+        sys.exit(1)
+    if args['-t'] not in (None, 'string', 'number'):
+        print('Error: Invalid encoding', args['-t'], file=sys.stderr)
+        sys.exit(1)
+    if args['-v'] and len(args['<dump>']) != len(args['-v']):
+        print('Error: Different number of memory dumps and values',
+              file=sys.stderr)
+        sys.exit(1)
+    if len(args['<dump>']) == 1 and not args['-v']:
+        print('Error: Analysis of one memory dump requires a value',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args['--verbose']:
+        print(args)
+    return (args['<dump>'], args['-n'], args['-v'], args['-t'],
+            args['--cache'], args['--mmap'], args['--jobs'],
+            args['--verbose'])
 
 
 def main(argv=None):
-    pdumps, ndumps, values, vtype = _process_cmd_line(argv)
-    # TODO: controlling the chain calls to modules
+    (pdumps, ndump, values, vtype, cachedir, mmapped, jobs,
+     verbose) = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    signatures = run_pipeline(pdumps, ndump, values, vtype, cachedir,
+                              mmapped, jobs)
+    for (score, root, labels) in signatures:
+        print('{:.2f} {}'.format(
+            score, signature_generator.format_signature(root, labels)))
     return 0
 
 
 # classes
 # internal functions & classes
 
+def _stage_key(stage, inputs):
+    key = hashlib.sha1('{}:{}'.format(stage, __version__))
+    for i in inputs:
+        key.update('\0{}'.format(i))
+    return key.hexdigest()
+
+
+def _stage_filename(cachedir, stage, key):
+    return os.path.join(cachedir, '{}-{}.pkl'.format(stage, key))
+
+
+def _load_stage(cachedir, stage, key):
+    """Returns the stored output of a stage, or None if there is no
+    valid output for its key.
+    """
+    filename = _stage_filename(cachedir, stage, key)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            output = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        logging.warning('Ignoring {}: {}'.format(filename, e))
+        return None
+    logging.debug('{} loaded'.format(filename))
+    return output
+
+
+def _store_stage(cachedir, stage, key, output):
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    filename = _stage_filename(cachedir, stage, key)
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(output, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp, filename)
+    logging.debug('{} created'.format(filename))
+
+
+def _node_keys(nodes):
+    return sorted((n.address, n.size) for n in nodes)
+
+
+def _seek_nodes(graph, keys):
+    """Returns the nodes of graph with the (address, size) keys.
+    """
+    keys = sorted(keys)
+    found = graph.seek_nodes_by_addresses([a for (a, _) in keys])
+    return set(n for (n, (a, s)) in zip(found, keys)
+               if n is not None and n.address == a and n.size == s)
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Generator of synthetic memory dumps with NT heap layouts.
+"""
+
+# imports
+from __future__ import print_function
+import logging
+import struct
+import sys
+
+from docopt import docopt
+import numpy as np
+
+
+# constants
+
+__version__ = 1.0
+_ALLOC_UNIT_SZ_ = 8
+_WORD_SZ_ = 4
+_HEAP_SEG_ = 64
+_HEAP_SIGNATURE_ = 0xeeffeeff
+_FIRST_ENTRY_ = 0x640
+_MAX_ENTRY_UNITS_ = 0xffff
+_REGION_ALIGN_ = 0x10000
+_FIRST_ADDRESS_ = 0x30000
+_USERM_INIT = 0x10000
+# !address report lines as filtered by the show_* scripts
+_HEAP_LINE_ = '{:08x}   Heap (Private {:08x}) : {:,} KB\n'
+_STACK_LINE_ = '  {:08x} - {:08x} : {:,} KB Thread Stack\n'
+_PDATA_LINE_ = '  {:08x} - {:08x} : {:,} KB Private Data\n'
+# minidump layout: header, stream directory, thread, module, memory
+# info and memory64 lists, module names and memory ranges
+_MD_HEADER_ = struct.Struct('<4sHHIIIIQ')
+_MD_DIRECTORY_ENTRY_ = struct.Struct('<III')
+_MD_THREAD_ = struct.Struct('<IIIIQQIIII')
+_MD_MODULE_SZ_ = 108
+_MD_MEMORY_INFO_ = struct.Struct('<QQIIQIIII')
+_MD_MODULE_PATH_ = u'C:\\Program Files\\synthetic\\'
+_MD_TEB_ = 0x7ffdf000
+_COPY_SZ_ = 1 << 20
+
+# exception classes
+
+
+# interface classes
+
+
+# interface functions
+
+def generate_dump(dumpfile, heaps=2, heap_size=1024, alloc_size=64,
+                  density=0.1, modules=4, module_size=64, stacks=2,
+                  stack_size=64, private_data=1, seed=0, snapshot=0,
+                  mutation=0.01, minidump=False):
+    """Writes a synthetic memory dump (.core, .segments, .modules,
+    .stacks, .heaps and .pdata files) with NT heap layouts. If
+    minidump is True the dump is also written as a .dmp minidump.
+
+    Sizes are given in KB, except for alloc_size which is the mean
+    allocation size in bytes. density is the fraction of words
+    holding a pointer to an allocation. Dumps with the same seed
+    share their layout and contents; a snapshot other than 0
+    rewrites one word in a "mutation" fraction of the allocations.
+
+    Returns the list of regions as (kind, address, size, name) tuples.
+    """
+    rs = np.random.RandomState(seed)
+    mutations = np.random.RandomState([seed, snapshot])
+    regions = _layout_regions(heaps, heap_size, modules, module_size,
+                              stacks, stack_size, private_data)
+    heap_regions = [r for r in regions if r[0] == 'heap']
+    entries = dict((r[1], _layout_heap_entries(rs, r[2], alloc_size))
+                   for r in heap_regions)
+    allocations = np.array(sorted(r[1] + o for r in heap_regions
+                                  for (o, _, used) in entries[r[1]] if used),
+                           dtype=np.uint32)
+    logging.debug('{} allocations laid out'.format(len(allocations)))
+
+    with open(dumpfile + '.core', 'wb') as f:
+        for (kind, address, size, name) in regions:
+            if kind == 'pdata':
+                words = rs.randint(0, _USERM_INIT, size / _WORD_SZ_)
+                data = bytearray(words.astype('<u4').tobytes())
+            else:
+                data = _fill_words(rs, size, allocations, density)
+            if kind == 'heap':
+                _write_heap(data, address, entries[address])
+                if snapshot:
+                    _mutate_heap(mutations, data, entries[address], mutation)
+            f.write(data)
+    logging.debug('{}.core created'.format(dumpfile))
+
+    with open(dumpfile + '.segments', 'w') as f:
+        for (_, address, size, _) in regions:
+            f.write('{:x}:{:x}\n'.format(address, size))
+    with open(dumpfile + '.modules', 'w') as f:
+        for (kind, address, size, name) in regions:
+            if kind == 'module':
+                f.write('{:x}:{:x}:{}\n'.format(address, size, name))
+    with open(dumpfile + '.heaps', 'w') as f:
+        for (kind, address, size, _) in regions:
+            if kind == 'heap':
+                f.write(_HEAP_LINE_.format(address, address + size,
+                                          size / 1024))
+    with open(dumpfile + '.stacks', 'w') as f:
+        for (kind, address, size, _) in regions:
+            if kind == 'stack':
+                f.write(_STACK_LINE_.format(address, address + size,
+                                           size / 1024))
+    with open(dumpfile + '.pdata', 'w') as f:
+        for (kind, address, size, _) in regions:
+            if kind == 'pdata':
+                f.write(_PDATA_LINE_.format(address, address + size,
+                                           size / 1024))
+    logging.debug('{} metadata created'.format(dumpfile))
+    if minidump:
+        write_minidump(dumpfile, regions)
+    return regions
+
+
+def write_minidump(dumpfile, regions):
+    """Writes the .dmp minidump of a synthetic memory dump from its
+    .core file and regions, with thread, module, memory info and
+    memory64 list streams.
+    """
+    stacks = [r for r in regions if r[0] == 'stack']
+    modules = [r for r in regions if r[0] == 'module']
+    streams = [(3, 4 + len(stacks) * _MD_THREAD_.size),
+               (4, 4 + len(modules) * _MD_MODULE_SZ_),
+               (16, 16 + len(regions) * _MD_MEMORY_INFO_.size),
+               (9, 16 + len(regions) * 16)]
+    rva = _MD_HEADER_.size + len(streams) * _MD_DIRECTORY_ENTRY_.size
+    header = [_MD_HEADER_.pack('MDMP', 0xa793, 0, len(streams),
+                               _MD_HEADER_.size, 0, 0, 0)]
+    rvas = dict()
+    for (stream_type, size) in streams:
+        header.append(_MD_DIRECTORY_ENTRY_.pack(stream_type, size, rva))
+        rvas[stream_type] = rva
+        rva += size
+    names = list()
+    for (_, _, _, name) in modules:
+        path = (_MD_MODULE_PATH_ + name.decode('ascii')).encode('utf-16-le')
+        names.append((rva, struct.pack('<I', len(path)) + path + '\0\0'))
+        rva += len(names[-1][1])
+    offsets = dict()
+    for (_, address, size, _) in regions:
+        offsets[address] = rva
+        rva += size
+
+    body = [struct.pack('<I', len(stacks))]
+    for (i, (_, address, size, _)) in enumerate(stacks):
+        body.append(_MD_THREAD_.pack(i + 1, 0, 0x20, 0, _MD_TEB_ - i * 0x1000,
+                                     address, size, offsets[address], 0, 0))
+    body.append(struct.pack('<I', len(modules)))
+    for ((_, address, size, _), (name_rva, _)) in zip(modules, names):
+        body.append(struct.pack('<QIIII', address, size, 0, 0, name_rva)
+                    .ljust(_MD_MODULE_SZ_, '\0'))
+    body.append(struct.pack('<IIQ', 16, _MD_MEMORY_INFO_.size, len(regions)))
+    for (kind, address, size, _) in regions:
+        # committed read/write regions, private but for the modules
+        body.append(_MD_MEMORY_INFO_.pack(
+            address, address, 4, 0, size, 0x1000, 4,
+            0x1000000 if kind == 'module' else 0x20000, 0))
+    body.append(struct.pack('<QQ', len(regions),
+                            offsets[regions[0][1]] if regions else rva))
+    for (_, address, size, _) in regions:
+        body.append(struct.pack('<QQ', address, size))
+    body.extend(n for (_, n) in names)
+
+    with open(dumpfile + '.dmp', 'wb') as f:
+        f.write(''.join(header + body))
+        with open(dumpfile + '.core', 'rb') as core:
+            for chunk in iter(lambda: core.read(_COPY_SZ_), ''):
+                f.write(chunk)
+    logging.debug('{}.dmp created'.format(dumpfile))
+
+
+# internal classes
+
+class _HeapEntryFlags:
+    USED = 0x01
+    END = 0x10
+
+
+# internal functions
+
+def _layout_regions(heaps, heap_size, modules, module_size, stacks,
+                    stack_size, private_data):
+    """Places every region at increasing, non-contiguous addresses."""
+    kinds = ([('stack', stack_size, None)] * stacks +
+             [('heap', heap_size, None)] * heaps +
+             [('pdata', 64, None)] * private_data +
+             [('module', module_size, 'module{}.dll'.format(i))
+              for i in xrange(modules)])
+    regions = list()
+    address = _FIRST_ADDRESS_
+    for (kind, size, name) in kinds:
+        size *= 1024
+        regions.append((kind, address, size, name))
+        address += size + _REGION_ALIGN_
+        address += -address % _REGION_ALIGN_
+    return regions
+
+
+def _layout_heap_entries(rs, size, alloc_size):
+    """Returns the HEAP_ENTRY chain of a heap segment as
+    (offset, units, used) tuples.
+    """
+    entries = list()
+    offset = _FIRST_ENTRY_
+    while offset < size:
+        units = max(2, int(rs.exponential(alloc_size)) / _ALLOC_UNIT_SZ_ + 2)
+        units = min(units, _MAX_ENTRY_UNITS_, (size - offset) /
+                    _ALLOC_UNIT_SZ_)
+        if (size - offset) / _ALLOC_UNIT_SZ_ - units < 2:
+            units = (size - offset) / _ALLOC_UNIT_SZ_
+            if units > _MAX_ENTRY_UNITS_:
+                units = _MAX_ENTRY_UNITS_ - 2
+        entries.append((offset, units, rs.random_sample() < 0.8))
+        offset += units * _ALLOC_UNIT_SZ_
+    return entries
+
+
+def _fill_words(rs, size, allocations, density):
+    """Returns the region bytes with a fraction of its words
+    pointing into allocations.
+    """
+    n = size / _WORD_SZ_
+    words = rs.randint(0, _USERM_INIT, n).astype(np.uint32)
+    if len(allocations):
+        mask = rs.random_sample(n) < density
+        targets = allocations[rs.randint(0, len(allocations), mask.sum())]
+        words[mask] = targets + _ALLOC_UNIT_SZ_
+    return bytearray(words.astype('<u4').tobytes())
+
+
+def _write_heap(data, address, entries):
+    """Writes the HEAP header, the segment list at +0x58 and the
+    HEAP_ENTRY chain into the heap region bytes.
+    """
+    struct.pack_into('<I', data, 0x8, _HEAP_SIGNATURE_)
+    struct.pack_into('<I', data, 0x58, address)
+    for i in xrange(1, _HEAP_SEG_):
+        struct.pack_into('<I', data, 0x58 + i * _WORD_SZ_, 0)
+    struct.pack_into('<I', data, 0x20, address + _FIRST_ENTRY_)
+    previous = 0
+    for (i, (offset, units, used)) in enumerate(entries):
+        flags = _HeapEntryFlags.USED if used else 0
+        if i == len(entries) - 1:
+            flags |= _HeapEntryFlags.END
+        # the unused bytes include the 8 bytes of the HEAP_ENTRY
+        unused = _ALLOC_UNIT_SZ_ + (offset / _ALLOC_UNIT_SZ_) % _ALLOC_UNIT_SZ_
+        struct.pack_into('<HHBBBB', data, offset, units, previous, 0, flags,
+                         unused, 0)
+        previous = units
+
+
+def _mutate_heap(rs, data, entries, mutation):
+    """Rewrites a random word in a fraction of the used entries.
+    """
+    for (offset, units, used) in entries:
+        if used and units > 2 and rs.random_sample() < mutation:
+            word = rs.randint(0, (units - 1) * _ALLOC_UNIT_SZ_ / _WORD_SZ_
+                              - 2)
+            struct.pack_into('<I', data, offset + _ALLOC_UNIT_SZ_ +
+                             word * _WORD_SZ_, rs.randint(0, _USERM_INIT))
+
+
+def _process_cmd_line(argv):
+    """Synthetic memory dump generator.
+
+Usage:
+    synthetic_dump.py [options] <dump>
+    synthetic_dump.py (--help | --version)
+
+Options:
+    <dump>                The memory dump base name.
+    --heaps <n>           Number of heaps [default: 2].
+    --heap-size <kb>      Size of each heap in KB [default: 1024].
+    --alloc-size <bytes>  Mean allocation size [default: 64].
+    --density <p>         Fraction of words that are pointers [default: 0.1].
+    --modules <n>         Number of modules [default: 4].
+    --module-size <kb>    Size of each module in KB [default: 64].
+    --stacks <n>          Number of stacks [default: 2].
+    --stack-size <kb>     Size of each stack in KB [default: 64].
+    --seed <n>            Random seed [default: 0].
+    --snapshot <n>        Snapshot number of the dump [default: 0].
+    --mutation <p>        Fraction of allocations changed in a snapshot
+                          [default: 0.01].
+    -d --minidump         Also writes the dump as a .dmp minidump.
+    -h --help             Shows this message.
+    -v --verbose          Shows details.
+    --version             Shows the current version.
+    """
+    # initializing the parser object
+    args = docopt(_process_cmd_line.__doc__, argv=argv, version=__version__)
+
+    # checking arguments
+    try:
+        options = dict(heaps=int(args['--heaps']),
+                       heap_size=int(args['--heap-size']),
+                       alloc_size=int(args['--alloc-size']),
+                       density=float(args['--density']),
+                       modules=int(args['--modules']),
+                       module_size=int(args['--module-size']),
+                       stacks=int(args['--stacks']),
+                       stack_size=int(args['--stack-size']),
+                       seed=int(args['--seed']),
+                       snapshot=int(args['--snapshot']),
+                       mutation=float(args['--mutation']),
+                       minidump=args['--minidump'])
+    except ValueError as e:
+        print('Error:', e, file=sys.stderr)
+        sys.exit(1)
+
+    if args['--verbose']:
+        print(args)
+    return args['<dump>'], options, args['--verbose']
+
+
+def main(argv=None):
+    dumpfile, options, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    regions = generate_dump(dumpfile, **options)
+    print('{} regions, {} bytes written'.format(
+        len(regions), sum(r[2] for r in regions)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
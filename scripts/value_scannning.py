@@ -6,41 +6,177 @@ Created on May 2, 2013
 """
 
 # imports
+from __future__ import print_function
 import argparse
+import logging
+import struct
 import sys
+
+import graph_cache
+import memorydump
 # constants
+_INT_FORMATS_ = [('int16', '<h', '<H'), ('int32', '<i', '<I'),
+                 ('int64', '<q', '<Q')]
+_FLOAT_FORMATS_ = [('float32', '<f'), ('float64', '<d')]
 # exception classes
 # interface functions
 
 
+def encode_value(value, vtype):
+    """Returns the (encoding, bytes) patterns of a value given as a
+    string. Strings are encoded in ASCII (UTF-8 when not ASCII) and
+    UTF-16LE; numbers as the little-endian integers they fit in and
+    as floats.
+    """
+    patterns = list()
+    if vtype == 'string':
+        text = value.decode('utf-8')
+        try:
+            patterns.append(('ascii', text.encode('ascii')))
+        except UnicodeEncodeError:
+            patterns.append(('utf-8', text.encode('utf-8')))
+        patterns.append(('utf-16le', text.encode('utf-16-le')))
+        return patterns
+    try:
+        number = int(value, 0)
+        for (encoding, signed, unsigned) in _INT_FORMATS_:
+            for fmt in (unsigned, signed):
+                try:
+                    patterns.append((encoding, struct.pack(fmt, number)))
+                    break
+                except struct.error:
+                    pass
+    except ValueError:
+        number = float(value)
+    for (encoding, fmt) in _FLOAT_FORMATS_:
+        try:
+            patterns.append((encoding, struct.pack(fmt, float(number))))
+        except (OverflowError, struct.error):
+            pass
+    return patterns
+
+
+def scan_memory_dump(dump, patterns):
+    """Returns the (address, encoding) hits of the patterns in the
+    heaps, modules and stacks of a memory dump, sorted by address.
+    """
+    groups = _prefix_groups(patterns)
+    hits = list()
+    for s in dump.heaps + dump.modules + dump.stacks:
+        start = s.offset
+        end = min(s.offset + s.size, len(dump.data))
+        for (offset, encoding) in _find_patterns(dump.data, groups, start,
+                                                 end):
+            hits.append((s.address + offset - start, encoding))
+    logging.debug('{} hits in {}'.format(len(hits), dump.name))
+    return sorted(hits)
+
+
+def value_nodes(graph, hits):
+    """Returns a dictionary from the nodes of a memory graph holding
+    any of the hits to their (address, encoding) hits.
+    """
+    nodes = dict()
+    found = graph.seek_nodes_by_addresses([a for (a, _) in hits])
+    for (node, hit) in zip(found, hits):
+        if node is not None:
+            nodes.setdefault(node, list()).append(hit)
+    return nodes
+
+
 def _process_cmd_line(argv):
-    """Returns a n-tuple: (...)
+    """Returns a 5-tuple: (dumps, values, type, mmapped, verbose).
     "argv" is a list of arguments, or "None" for "sys.argv[1:]".
     """
     if argv is None:
         argv = sys.argv[1:]
 
     # initializing the parser object
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='Scans memory dumps for '
+                                                 'the encodings of a value')
     # defining command options
-    # parser.add_argument()
+    parser.add_argument('-p', required=True, nargs='+', dest='dumps',
+                        metavar='dump', help='list of memory dumps')
+    parser.add_argument('-v', required=True, nargs='+', dest='values',
+                        metavar='value',
+                        help="memory dumps' corresponding values")
+    parser.add_argument('-t', required=True, dest='type',
+                        choices=['string', 'number'],
+                        help='possible encodings')
+    parser.add_argument('-m', '--mmap', action='store_true',
+                        help='memory-maps the .core files')
+    parser.add_argument('--verbose', action='store_true',
+                        help='shows details')
 
     # parsing arguments
     args = parser.parse_args(argv)
 
     # checking arguments
-    # if arg...
-    return args
+    if len(args.values) == 1:
+        args.values *= len(args.dumps)
+    if len(args.dumps) != len(args.values):
+        parser.error('Different number of memory dumps and values')
+    if args.type == 'number':
+        for value in args.values:
+            try:
+                encode_value(value, args.type)
+            except ValueError:
+                parser.error('Invalid number {}'.format(value))
+    return args.dumps, args.values, args.type, args.mmap, args.verbose
 
 
 def main(argv=None):
-    # args = _process_cmd_line(argv)
-    pass
+    dumpfiles, values, vtype, mmapped, verbose = _process_cmd_line(argv)
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    for (dumpfile, value) in zip(dumpfiles, values):
+        dump = memorydump.load_memory_dump(dumpfile, mmapped)
+        graph = graph_cache.cached_graph(dump)
+        nodes = value_nodes(graph, scan_memory_dump(
+            dump, encode_value(value, vtype)))
+        for node in sorted(nodes, key=lambda n: n.address):
+            for (address, encoding) in nodes[node]:
+                print('{}: {:#010x} {} {!r}'.format(dumpfile, address,
+                                                    encoding, node))
+    return 0
 
 
 # classes
 # internal functions & classes
 
+def _prefix_groups(patterns):
+    """Groups the patterns under the shortest pattern that is a
+    prefix of them, so the occurrences of a group are found with a
+    single search.
+    """
+    groups = list()
+    for (encoding, pattern) in sorted(patterns, key=lambda p: len(p[1])):
+        if not pattern:
+            continue
+        for (prefix, members) in groups:
+            if pattern.startswith(prefix):
+                members.append((encoding, pattern))
+                break
+        else:
+            groups.append((pattern, [(encoding, pattern)]))
+    return groups
+
+
+def _find_patterns(data, groups, start, end):
+    """Yields the (offset, encoding) occurrences of the grouped
+    patterns in data between start and end.
+    """
+    for (prefix, members) in groups:
+        i = data.find(prefix, start, end)
+        while i != -1:
+            for (encoding, pattern) in members:
+                if (len(pattern) == len(prefix) or
+                        (i + len(pattern) <= end and
+                         data[i:i + len(pattern)] == pattern)):
+                    yield i, encoding
+            i = data.find(prefix, i + 1, end)
+
 
 if __name__ == '__main__':
     sys.exit(main())